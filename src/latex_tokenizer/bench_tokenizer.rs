@@ -0,0 +1,49 @@
+// This Source Code Form is subject to the terms of the Mozilla Public
+// License, v. 2.0. If a copy of the MPL was not distributed with this
+// file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+extern crate latex_tokenizer;
+
+use latex_tokenizer::{LatexTokenizer};
+
+use std::env;
+use std::fs;
+use std::time::{Instant};
+
+// Usage: bench_tokenizer <ITERATIONS> <FILE>...
+//
+// Tokenizes each file ITERATIONS times and prints one tab-separated line per
+// file: path, chars, tokens, best seconds, and "ok" or the error. The last
+// line is the peak resident set size of the process, in kB, on platforms that
+// report it (see src/py/math_brain/bench_tokenizer.py).
+fn main() {
+  let args: Vec<String> = env::args().collect();
+  let iterations: usize = args[1].parse().unwrap();
+  for path in args[2..].iter() {
+    let source = String::from_utf8_lossy(&fs::read(path).unwrap()).into_owned();
+    let chars = source.chars().count();
+    let mut best = f64::INFINITY;
+    let mut result = None;
+    for _ in 0..iterations {
+      let start = Instant::now();
+      let tokens = LatexTokenizer::new().tokenize(&source);
+      let elapsed = start.elapsed().as_secs_f64();
+      if elapsed < best {
+        best = elapsed;
+      }
+      result = Some(tokens);
+    }
+    match result {
+      Some(Ok(tokens)) => println!("{}\t{}\t{}\t{}\tok", path, chars, tokens.len(), best),
+      Some(Err(e)) => println!("{}\t{}\t0\t{}\t{:?}", path, chars, best, e),
+      None => {}
+    }
+  }
+  let peak_kb = fs::read_to_string("/proc/self/status").ok()
+    .and_then(|status| status.lines()
+      .find(|line| line.starts_with("VmHWM:"))
+      .and_then(|line| line.split_whitespace().nth(1))
+      .and_then(|kb| kb.parse::<u64>().ok()))
+    .unwrap_or(0);
+  println!("peak_kb\t{}", peak_kb);
+}
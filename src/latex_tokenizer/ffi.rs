@@ -0,0 +1,133 @@
+// This Source Code Form is subject to the terms of the Mozilla Public
+// License, v. 2.0. If a copy of the MPL was not distributed with this
+// file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+// C ABI over LatexTokenizer, loaded with ctypes by RustLatexTokenizer in
+// src/py/math_brain/latex_tokenizer.py.
+//
+// Tokens come back as flat arrays rather than one object per token: a kind
+// per token (the LatexToken variant index, which matches the order of
+// TokenStream.kind_classes on the Python side), the payload length in chars
+// of each Text/Number/Command/Symbol/Punct token, and all payloads
+// concatenated as utf-8.
+
+use crate::{LatexToken, LatexTokenizer};
+
+use std::ptr;
+use std::slice;
+use std::str;
+
+#[repr(C)]
+pub struct LatexTokenizerOutput {
+  pub kinds:        *const u8,
+  pub num_tokens:   usize,
+  pub lengths:      *const u32,
+  pub num_lengths:  usize,
+  pub text:         *const u8,
+  pub text_len:     usize,
+  // utf-8 description of the error, or null on success
+  pub error:        *const u8,
+  pub error_len:    usize,
+  owner:            *mut Buffers,
+}
+
+struct Buffers {
+  kinds:    Vec<u8>,
+  lengths:  Vec<u32>,
+  text:     String,
+  error:    Option<String>,
+}
+
+impl Buffers {
+  fn push_text(&mut self, s: &str) {
+    self.lengths.push(s.chars().count() as u32);
+    self.text.push_str(s);
+  }
+
+  fn push_char(&mut self, c: char) {
+    self.lengths.push(1);
+    self.text.push(c);
+  }
+
+  fn push(&mut self, tok: &LatexToken) {
+    let kind = match tok {
+      LatexToken::Text(s) => { self.push_text(s); 0 }
+      LatexToken::Number(s) => { self.push_text(s); 1 }
+      LatexToken::Command(s) => { self.push_text(s); 2 }
+      LatexToken::Symbol(c) => { self.push_char(*c); 3 }
+      LatexToken::Punct(c) => { self.push_char(*c); 4 }
+      LatexToken::LBrack => 5,
+      LatexToken::RBrack => 6,
+      LatexToken::LCurly => 7,
+      LatexToken::RCurly => 8,
+      LatexToken::LParen => 9,
+      LatexToken::RParen => 10,
+      LatexToken::LQuote => 11,
+      LatexToken::RQuote => 12,
+      LatexToken::LDQuote => 13,
+      LatexToken::RDQuote => 14,
+      LatexToken::VBar => 15,
+      LatexToken::Space => 16,
+      LatexToken::Super => 17,
+      LatexToken::Sub => 18,
+      LatexToken::LGroup => 19,
+      LatexToken::RGroup => 20,
+      LatexToken::StartInlineMath => 21,
+      LatexToken::EndInlineMath => 22,
+      LatexToken::StartDisplayMath => 23,
+      LatexToken::EndDisplayMath => 24,
+    };
+    self.kinds.push(kind);
+  }
+}
+
+/// Tokenizes the utf-8 string source[..len] into *out, which must later be
+/// released with latex_tokenizer_free(). Returns false (and leaves *out
+/// untouched) if the source is not valid utf-8.
+#[no_mangle]
+pub unsafe extern "C" fn latex_tokenizer_tokenize(source: *const u8, len: usize, out: *mut LatexTokenizerOutput) -> bool {
+  let source = match str::from_utf8(slice::from_raw_parts(source, len)) {
+    Ok(source) => source,
+    Err(_) => return false,
+  };
+  let mut buffers = Box::new(Buffers{
+    kinds:    Vec::new(),
+    lengths:  Vec::new(),
+    text:     String::new(),
+    error:    None,
+  });
+  match LatexTokenizer::new().tokenize(source) {
+    Ok(toks) => {
+      for tok in toks.iter() {
+        buffers.push(tok);
+      }
+    }
+    Err(e) => {
+      buffers.error = Some(format!("{:?}", e));
+    }
+  }
+  let (error, error_len) = match &buffers.error {
+    Some(e) => (e.as_ptr(), e.len()),
+    None => (ptr::null(), 0),
+  };
+  *out = LatexTokenizerOutput{
+    kinds:        buffers.kinds.as_ptr(),
+    num_tokens:   buffers.kinds.len(),
+    lengths:      buffers.lengths.as_ptr(),
+    num_lengths:  buffers.lengths.len(),
+    text:         buffers.text.as_ptr(),
+    text_len:     buffers.text.len(),
+    error,
+    error_len,
+    owner:        Box::into_raw(buffers),
+  };
+  true
+}
+
+#[no_mangle]
+pub unsafe extern "C" fn latex_tokenizer_free(out: *mut LatexTokenizerOutput) {
+  if !(*out).owner.is_null() {
+    drop(Box::from_raw((*out).owner));
+    (*out).owner = ptr::null_mut();
+  }
+}
@@ -8,6 +8,8 @@ use std::fs::{File};
 use std::io::{BufRead, BufReader, Error as IoError};
 use std::path::{Path};
 
+pub mod ffi;
+
 #[derive(Debug)]
 pub enum LatexTokenizerError {
   Io(IoError),
@@ -46,22 +48,32 @@ pub enum LatexToken {
   EndDisplayMath,
 }
 
-#[derive(Clone, Copy, Debug)]
+#[derive(Clone, Copy, PartialEq, Debug)]
 enum MathStart {
   Dollar,
   LBrack,
 }
 
+#[derive(Clone, Copy, PartialEq, Debug)]
+enum Pos {
+  Begin,
+  End,
+}
+
+// The items, and how they handle each char, mirror those of LatexTokenizer in
+// src/py/math_brain/latex_tokenizer.py, so that both produce the same tokens.
 #[derive(Debug)]
 enum Item {
-  Text(String),
-  Number(String),
+  // None is an empty buffer. The initial Text item has Some(""), whose empty
+  // text is still committed, as is that of the Python tokenizer's Text('').
+  Text(Option<String>),
   Command(String),
   LQuote,
   RQuote,
   Space,
-  InlineMath(MathStart, bool, String),
-  DisplayMath(bool, String),
+  InlineMath(MathStart, Pos),
+  // Also the number of closing '$' seen.
+  DisplayMath(Pos, u8),
 }
 
 #[derive(Debug)]
@@ -71,6 +83,38 @@ enum Mode {
   DisplayMath,
 }
 
+// The char classes of Python's str.isspace(), isalpha() and isnumeric(). Rust's
+// differ: e.g. '\x1c' is no whitespace, and letter numbers are alphabetic.
+fn is_space(c: char) -> bool {
+  c.is_whitespace() || ('\x1c' ..= '\x1f').contains(&c)
+}
+
+fn is_alpha(c: char) -> bool {
+  c.is_alphabetic() && !c.is_numeric()
+}
+
+fn is_numeric(c: char) -> bool {
+  c.is_numeric()
+}
+
+// The token of a char that is a token of its own in math mode.
+fn math_char_token(c: char) -> Option<LatexToken> {
+  Some(match c {
+    '.' | ',' | '?' | ';' | ':' => LatexToken::Punct(c),
+    '+' | '-' | '<' | '>' | '=' => LatexToken::Symbol(c),
+    '[' => LatexToken::LBrack,
+    ']' => LatexToken::RBrack,
+    '(' => LatexToken::LParen,
+    ')' => LatexToken::RParen,
+    '{' => LatexToken::LCurly,
+    '}' => LatexToken::RCurly,
+    '^' => LatexToken::Super,
+    '_' => LatexToken::Sub,
+    '\'' => LatexToken::RQuote,
+    _ => return None,
+  })
+}
+
 pub struct LatexTokenizer {
   stack:    Vec<Item>,
   mode:     Mode,
@@ -80,399 +124,256 @@ pub struct LatexTokenizer {
 impl LatexTokenizer {
   pub fn new() -> LatexTokenizer {
     LatexTokenizer{
-      stack:    vec![Item::Text(String::new())],
+      stack:    vec![Item::Text(Some(String::new()))],
       mode:     Mode::Text,
       toks:     Vec::new(),
     }
   }
 
-  fn _tokenize_math_char<F: FnOnce(&mut LatexTokenizer), G: Fn(&mut LatexTokenizer, String)>(&mut self, mut buf: String, c: char, push_math: F, push_math2: G) {
-    if c == '+' || c == '-' || c == '<' || c == '>' {
-      if !buf.is_empty() {
-        self.toks.push(LatexToken::Text(buf).into());
-      }
-      self.toks.push(LatexToken::Symbol(c).into());
-      //self.stack.push(Item::InlineMath(start, false, String::new()));
-      (push_math)(self);
-    } else if c == '.' || c == ',' || c == '?' || c == ';' || c == ':' {
-      if !buf.is_empty() {
-        self.toks.push(LatexToken::Text(buf).into());
-      }
-      self.toks.push(LatexToken::Punct(c).into());
-      //self.stack.push(Item::InlineMath(start, false, String::new()));
-      (push_math)(self);
-    } else if c == '[' {
-      if !buf.is_empty() {
-        self.toks.push(LatexToken::Text(buf).into());
-      }
-      self.toks.push(LatexToken::LBrack.into());
-      //self.stack.push(Item::InlineMath(start, false, String::new()));
-      (push_math)(self);
-    } else if c == ']' {
-      if !buf.is_empty() {
-        self.toks.push(LatexToken::Text(buf).into());
-      }
-      self.toks.push(LatexToken::RBrack.into());
-      //self.stack.push(Item::InlineMath(start, false, String::new()));
-      (push_math)(self);
-    } else if c == '(' {
-      if !buf.is_empty() {
-        self.toks.push(LatexToken::Text(buf).into());
-      }
-      self.toks.push(LatexToken::LParen.into());
-      //self.stack.push(Item::InlineMath(start, false, String::new()));
-      (push_math)(self);
-    } else if c == ')' {
-      if !buf.is_empty() {
-        self.toks.push(LatexToken::Text(buf).into());
-      }
-      self.toks.push(LatexToken::RParen.into());
-      //self.stack.push(Item::InlineMath(start, false, String::new()));
-      (push_math)(self);
+  fn _commit_text(&mut self, buf: Option<String>) {
+    if let Some(buf) = buf {
+      self.toks.push(LatexToken::Text(buf));
+    }
+  }
+
+  fn _tokenize_math_char(&mut self, math_item: Item, c: char) {
+    if let Some(tok) = math_char_token(c) {
+      self.toks.push(tok);
+      self.stack.push(math_item);
+    } else if is_space(c) {
+      // math-mode can ignore whitespace
+      self.stack.push(math_item);
+    } else if is_numeric(c) {
+      self.stack.push(math_item);
+      self.toks.push(LatexToken::Number(c.to_string()));
     } else if c == '\\' {
-      if !buf.is_empty() {
-        self.toks.push(LatexToken::Text(buf).into());
-      }
-      //self.stack.push(Item::InlineMath(start, false, String::new()));
-      (push_math)(self);
+      self.stack.push(math_item);
       self.stack.push(Item::Command(String::new()));
-    } else if c.is_whitespace() {
-      if !buf.is_empty() {
-        self.toks.push(LatexToken::Text(buf).into());
-      }
-      //self.stack.push(Item::InlineMath(start, false, String::new()));
-      (push_math)(self);
-      self.stack.push(Item::Space);
-    } else if c == '^' {
-      if !buf.is_empty() {
-        self.toks.push(LatexToken::Text(buf).into());
-      }
-      self.toks.push(LatexToken::Super.into());
-      //self.stack.push(Item::InlineMath(start, false, String::new()));
-      (push_math)(self);
-    } else if c == '_' {
-      if !buf.is_empty() {
-        self.toks.push(LatexToken::Text(buf).into());
-      }
-      self.toks.push(LatexToken::Sub.into());
-      //self.stack.push(Item::InlineMath(start, false, String::new()));
-      (push_math)(self);
-    } else if c == '{' {
-      if !buf.is_empty() {
-        self.toks.push(LatexToken::Text(buf).into());
-      }
-      self.toks.push(LatexToken::LGroup.into());
-      //self.stack.push(Item::InlineMath(start, false, String::new()));
-      (push_math)(self);
-    } else if c == '}' {
-      if !buf.is_empty() {
-        self.toks.push(LatexToken::Text(buf).into());
-      }
-      self.toks.push(LatexToken::RGroup.into());
-      //self.stack.push(Item::InlineMath(start, false, String::new()));
-      (push_math)(self);
-    } else if c == '\'' {
-      /*buf.push(c);
-      self.stack.push(Item::InlineMath(start, false, buf));*/
-      if !buf.is_empty() {
-        self.toks.push(LatexToken::Text(buf).into());
-      }
-      self.toks.push(LatexToken::LQuote.into());
-      //self.stack.push(Item::InlineMath(start, false, String::new()));
-      (push_math)(self);
-    } else if c.is_numeric() {
-      if !buf.is_empty() {
-        self.toks.push(LatexToken::Text(buf).into());
-      }
-      //self.stack.push(Item::InlineMath(start, false, String::new()));
-      (push_math)(self);
-      self.stack.push(Item::Number(c.to_string()));
     } else {
-      if buf.is_empty() {
-        buf.push(c);
-        //self.stack.push(Item::InlineMath(start, false, buf));
-        (push_math2)(self, buf);
-      } else {
-        self.toks.push(LatexToken::Text(buf).into());
-        //self.stack.push(Item::InlineMath(start, false, c.to_string()));
-        (push_math2)(self, c.to_string());
-      }
+      self.toks.push(LatexToken::Text(c.to_string()));
+      self.stack.push(math_item);
     }
   }
 
-  fn _tokenize_char(&mut self, _idx: usize, c: char) -> Result<(), LatexTokenizerError> {
-    loop {
-      let item = self.stack.pop();
-      match item {
-        Some(Item::Text(mut buf)) => {
-          self.mode = Mode::Text;
-          if c == '$' {
-            if !buf.is_empty() {
-              self.toks.push(LatexToken::Text(buf).into());
-            }
-            self.stack.push(Item::Text(String::new()));
-            self.stack.push(Item::InlineMath(MathStart::Dollar, true, String::new()));
-          } else if c == '.' || c == ',' || c == '?' || c == ';' || c == ':' {
-            if !buf.is_empty() {
-              self.toks.push(LatexToken::Text(buf).into());
-            }
-            self.toks.push(LatexToken::Punct(c).into());
-            self.stack.push(Item::Text(String::new()));
-          } else if c == '(' {
-            if !buf.is_empty() {
-              self.toks.push(LatexToken::Text(buf).into());
-            }
-            self.toks.push(LatexToken::LParen.into());
-            self.stack.push(Item::Text(String::new()));
-          } else if c == ')' {
-            if !buf.is_empty() {
-              self.toks.push(LatexToken::Text(buf).into());
-            }
-            self.toks.push(LatexToken::RParen.into());
-            self.stack.push(Item::Text(String::new()));
-          } else if c == '`' {
-            if !buf.is_empty() {
-              self.toks.push(LatexToken::Text(buf).into());
-            }
-            self.stack.push(Item::Text(String::new()));
-            self.stack.push(Item::LQuote);
-          } else if c == '\'' {
-            if !buf.is_empty() {
-              self.toks.push(LatexToken::Text(buf).into());
-            }
-            self.stack.push(Item::Text(String::new()));
-            self.stack.push(Item::RQuote);
-          } else if c == '\\' {
-            if !buf.is_empty() {
-              self.toks.push(LatexToken::Text(buf).into());
-            }
-            self.stack.push(Item::Text(String::new()));
-            self.stack.push(Item::Command(c.to_string()));
-          } else if c.is_whitespace() {
-            if !buf.is_empty() {
-              self.toks.push(LatexToken::Text(buf).into());
-            }
-            self.stack.push(Item::Text(String::new()));
+  // Returns whether the item below should handle c too.
+  fn _handle(&mut self, item: Item, c: char) -> Result<bool, LatexTokenizerError> {
+    match item {
+      Item::Text(buf) => {
+        self.mode = Mode::Text;
+        match c {
+          '$' => {
+            self._commit_text(buf);
+            self.stack.push(Item::Text(None));
+            self.stack.push(Item::InlineMath(MathStart::Dollar, Pos::Begin));
+          }
+          '.' | ',' | '?' | ';' | ':' | '(' | ')' | '{' | '}' => {
+            self._commit_text(buf);
+            self.toks.push(match c {
+              '(' => LatexToken::LParen,
+              ')' => LatexToken::RParen,
+              '{' => LatexToken::LGroup,
+              '}' => LatexToken::RGroup,
+              _ => LatexToken::Punct(c),
+            });
+            self.stack.push(Item::Text(None));
+          }
+          '`' | '\'' | '\\' => {
+            self._commit_text(buf);
+            self.stack.push(Item::Text(None));
+            self.stack.push(match c {
+              '`' => Item::LQuote,
+              '\'' => Item::RQuote,
+              _ => Item::Command(c.to_string()),
+            });
+          }
+          _ if is_space(c) => {
+            self._commit_text(buf);
+            self.stack.push(Item::Text(None));
             self.stack.push(Item::Space);
-          } else if c == '^' {
-            //panic!("BUG: syntax error: superscript in text mode");
-            return Err(LatexTokenizerError::Unexpected("^"));
-          } else if c == '_' {
-            //panic!("BUG: syntax error: subscript in text mode");
-            return Err(LatexTokenizerError::Unexpected("_"));
-          } else if c == '{' {
-            if !buf.is_empty() {
-              self.toks.push(LatexToken::Text(buf).into());
-            }
-            self.toks.push(LatexToken::LGroup.into());
-            self.stack.push(Item::Text(String::new()));
-          } else if c == '}' {
-            if !buf.is_empty() {
-              self.toks.push(LatexToken::Text(buf).into());
-            }
-            self.toks.push(LatexToken::RGroup.into());
-            self.stack.push(Item::Text(String::new()));
-          } else {
+          }
+          _ => {
+            let mut buf = buf.unwrap_or_default();
             buf.push(c);
-            self.stack.push(Item::Text(buf));
+            self.stack.push(Item::Text(Some(buf)));
           }
         }
-        Some(Item::LQuote) => {
-          if c == '`' {
-            self.toks.push(LatexToken::LDQuote.into());
-          } else {
-            self.toks.push(LatexToken::LQuote.into());
-            continue;
-          }
+      }
+      Item::LQuote => {
+        if c == '`' {
+          self.toks.push(LatexToken::LDQuote);
+        } else {
+          self.toks.push(LatexToken::LQuote);
+          return Ok(true);
         }
-        Some(Item::RQuote) => {
-          if c == '\'' {
-            self.toks.push(LatexToken::RDQuote.into());
-          } else {
-            self.toks.push(LatexToken::RQuote.into());
-            continue;
-          }
+      }
+      Item::RQuote => {
+        if c == '\'' {
+          self.toks.push(LatexToken::RDQuote);
+        } else {
+          self.toks.push(LatexToken::RQuote);
+          return Ok(true);
         }
-        Some(Item::Number(mut buf)) => {
-          if c.is_numeric() {
-            buf.push(c);
-            self.stack.push(Item::Number(buf));
-          } else {
-            assert!(!buf.is_empty(), "bug");
-            self.toks.push(LatexToken::Number(buf).into());
-            continue;
+      }
+      Item::Command(mut buf) => {
+        // FIXME: symbolic commands.
+        if buf.is_empty() && c == '[' {
+          match self.stack.pop() {
+            Some(Item::Text(text_buf)) => {
+              self._commit_text(text_buf);
+              self.toks.push(LatexToken::StartInlineMath);
+              self.stack.push(Item::Text(None));
+              self.stack.push(Item::InlineMath(MathStart::LBrack, Pos::End));
+            }
+            Some(_) | None => {
+              return Err(LatexTokenizerError::Unexpected("\\["));
+            }
           }
-        }
-        Some(Item::Command(mut buf)) => {
-          // FIXME: symbolic commands.
-          if buf.is_empty() && c == '[' {
-            match self.stack.pop() {
-              Some(Item::Text(text_buf)) => {
-                if !text_buf.is_empty() {
-                  self.toks.push(LatexToken::Text(text_buf).into());
-                }
-                self.toks.push(LatexToken::StartInlineMath.into());
-                self.stack.push(Item::Text(String::new()));
-                self.stack.push(Item::InlineMath(MathStart::LBrack, false, String::new()));
-              }
-              Some(_) | None => {
-                return Err(LatexTokenizerError::Unexpected("\\["));
-              }
+        } else if buf.is_empty() && c == ']' {
+          match self.stack.pop() {
+            Some(Item::InlineMath(MathStart::LBrack, _)) => {
+              self.toks.push(LatexToken::EndInlineMath);
             }
-          } else if buf.is_empty() && c == ']' {
-            match self.stack.pop() {
-              Some(Item::InlineMath(start, _init, math_buf)) => {
-                match start {
-                  MathStart::LBrack => {
-                    if !math_buf.is_empty() {
-                      self.toks.push(LatexToken::Text(math_buf).into());
-                    }
-                    self.toks.push(LatexToken::EndInlineMath.into());
-                  }
-                  MathStart::Dollar => {
-                    return Err(LatexTokenizerError::MismatchedMath("$", "\\]"));
-                  }
-                }
-              }
-              Some(_) | None => {
-                return Err(LatexTokenizerError::Unexpected("\\]"));
-              }
+            Some(Item::InlineMath(MathStart::Dollar, _)) => {
+              return Err(LatexTokenizerError::MismatchedMath("$", "\\]"));
             }
-          } else if buf.is_empty() && c == '{' {
-            self.toks.push(LatexToken::LCurly.into());
-          } else if buf.is_empty() && c == '}' {
-            self.toks.push(LatexToken::RCurly.into());
-          } else if buf.is_empty() && c == '|' {
-            self.toks.push(LatexToken::VBar.into());
-          } else if c.is_alphabetic() {
-            buf.push(c);
-            self.stack.push(Item::Command(buf));
-          } else {
-            if buf.is_empty() {
-              return Err(LatexTokenizerError::UnexpectedCmd(c));
+            Some(_) | None => {
+              return Err(LatexTokenizerError::Unexpected("\\]"));
             }
-            self.toks.push(LatexToken::Command(buf).into());
-            continue;
           }
-        }
-        Some(Item::Space) => {
-          if c.is_whitespace() {
-            self.stack.push(item.unwrap());
-          } else {
-            match self.mode {
-              Mode::Text => {
-                self.toks.push(LatexToken::Space.into());
-              }
-              Mode::InlineMath | Mode::DisplayMath => {}
-            }
-            continue;
+        } else if buf.is_empty() && c == '{' {
+          self.toks.push(LatexToken::LCurly);
+        } else if buf.is_empty() && c == '}' {
+          self.toks.push(LatexToken::RCurly);
+        } else if buf.is_empty() && c == '|' {
+          self.toks.push(LatexToken::VBar);
+        } else if is_alpha(c) {
+          buf.push(c);
+          self.stack.push(Item::Command(buf));
+        } else if c == ' ' {
+          if buf.is_empty() {
+            // "\ " is a whitespace command
+            buf.push(c);
+          }
+          self.toks.push(LatexToken::Command(buf));
+          return Ok(true);
+        } else {
+          if buf.is_empty() {
+            return Err(LatexTokenizerError::UnexpectedCmd(c));
           }
+          self.toks.push(LatexToken::Command(buf));
+          return Ok(true);
         }
-        Some(Item::InlineMath(start, init, buf)) => {
-          self.mode = Mode::InlineMath;
-          if init {
-            if c == '$' {
-              match start {
-                MathStart::Dollar => {
-                  assert!(buf.is_empty(), "bug");
-                  self.stack.push(Item::DisplayMath(false, buf));
-                  break;
-                }
-                MathStart::LBrack => {
-                  return Err(LatexTokenizerError::Unexpected("\\[$"));
-                }
-              }
-            } else {
-              self.toks.push(LatexToken::StartInlineMath.into());
+      }
+      Item::Space => {
+        if is_space(c) {
+          self.stack.push(Item::Space);
+        } else {
+          match self.mode {
+            Mode::Text => {
+              self.toks.push(LatexToken::Space);
             }
+            Mode::InlineMath | Mode::DisplayMath => {}
           }
+          return Ok(true);
+        }
+      }
+      Item::InlineMath(start, pos) => {
+        self.mode = Mode::InlineMath;
+        if pos == Pos::Begin {
           if c == '$' {
-            match start {
-              MathStart::Dollar => {
-                if !buf.is_empty() {
-                  self.toks.push(LatexToken::Text(buf).into());
-                }
-                self.toks.push(LatexToken::EndInlineMath.into());
-              }
-              MathStart::LBrack => {
-                return Err(LatexTokenizerError::MismatchedMath("\\[", "$"));
-              }
+            if start != MathStart::Dollar {
+              return Err(LatexTokenizerError::Unexpected("\\[$"));
             }
-          } else {
-            self._tokenize_math_char(buf, c,
-                move |this| this.stack.push(Item::InlineMath(start, false, String::new())),
-                move |this, buf| this.stack.push(Item::InlineMath(start, false, buf)),
-            );
+            self.stack.push(Item::Text(None));
+            self.stack.push(Item::DisplayMath(Pos::Begin, 0));
+            return Ok(false);
           }
+          self.toks.push(LatexToken::StartInlineMath);
         }
-        Some(Item::DisplayMath(end, buf)) => {
-          self.mode = Mode::DisplayMath;
-          if end {
-            if c == '$' {
-              self.toks.push(LatexToken::EndDisplayMath.into());
-              break;
-            } else {
-              return Err(LatexTokenizerError::MismatchedMath("$$", "$"));
+        if c == '$' {
+          match start {
+            MathStart::Dollar => {
+              self.toks.push(LatexToken::EndInlineMath);
+            }
+            MathStart::LBrack => {
+              return Err(LatexTokenizerError::MismatchedMath("\\[", "$"));
             }
           }
+        } else {
+          self._tokenize_math_char(Item::InlineMath(start, Pos::End), c);
+        }
+      }
+      Item::DisplayMath(pos, close_count) => {
+        self.mode = Mode::DisplayMath;
+        if pos == Pos::Begin {
+          // like the Python tokenizer, this consumes the char after "$$"
           if c == '$' {
-            self.stack.push(Item::DisplayMath(true, buf));
+            return Err(LatexTokenizerError::Unexpected("$$$"));
+          }
+          self.toks.push(LatexToken::StartDisplayMath);
+          self.stack.push(Item::Text(None));
+          self.stack.push(Item::DisplayMath(Pos::End, 0));
+          return Ok(false);
+        }
+        if c == '$' {
+          if close_count == 0 {
+            self.stack.push(Item::DisplayMath(pos, 1));
           } else {
-            self._tokenize_math_char(buf, c,
-                move |this| this.stack.push(Item::DisplayMath(false, String::new())),
-                move |this, buf| this.stack.push(Item::DisplayMath(false, buf)),
-            );
+            self.toks.push(LatexToken::EndDisplayMath);
           }
+        } else {
+          self._tokenize_math_char(Item::DisplayMath(Pos::End, close_count), c);
         }
-        None => panic!("bug")
       }
-      break;
+    }
+    Ok(false)
+  }
+
+  fn _tokenize_char(&mut self, c: char) -> Result<(), LatexTokenizerError> {
+    while let Some(item) = self.stack.pop() {
+      if !self._handle(item, c)? {
+        break;
+      }
     }
     Ok(())
   }
 
   pub fn tokenize(mut self, source: &str) -> Result<Vec<LatexToken>, LatexTokenizerError> {
-    for (idx, c) in source.char_indices() {
-      self._tokenize_char(idx, c)?;
+    for c in source.chars() {
+      self._tokenize_char(c)?;
     }
-    match self.stack.pop() {
-      Some(Item::Text(buf)) => {
-        if !buf.is_empty() {
-          self.toks.push(LatexToken::Text(buf).into());
+    // Flush pending items from the top of the stack down.
+    while let Some(item) = self.stack.pop() {
+      match item {
+        Item::Text(buf) => {
+          self._commit_text(buf);
         }
-      }
-      Some(Item::LQuote) => {
-        self.toks.push(LatexToken::LQuote.into());
-      }
-      Some(Item::RQuote) => {
-        self.toks.push(LatexToken::RQuote.into());
-      }
-      Some(Item::Number(buf)) => {
-        if !buf.is_empty() {
-          self.toks.push(LatexToken::Number(buf).into());
+        Item::Command(buf) => {
+          if !buf.is_empty() {
+            self.toks.push(LatexToken::Command(buf));
+          }
         }
-      }
-      Some(Item::Command(buf)) => {
-        if !buf.is_empty() {
-          self.toks.push(LatexToken::Command(buf).into());
+        Item::LQuote => {
+          self.toks.push(LatexToken::LQuote);
+        }
+        Item::RQuote => {
+          self.toks.push(LatexToken::RQuote);
+        }
+        Item::Space => {
+          self.toks.push(LatexToken::Space);
+        }
+        Item::InlineMath(start, _) => {
+          let start = match start {
+            MathStart::Dollar => "$",
+            MathStart::LBrack => "\\[",
+          };
+          return Err(LatexTokenizerError::Unterminated(start));
+        }
+        Item::DisplayMath(..) => {
+          return Err(LatexTokenizerError::Unterminated("$$"));
         }
       }
-      Some(Item::Space) => {
-        self.toks.push(LatexToken::Space.into());
-      }
-      Some(Item::InlineMath(start, ..)) => {
-        let start = match start {
-          MathStart::Dollar => "$",
-          MathStart::LBrack => "\\[",
-        };
-        return Err(LatexTokenizerError::Unterminated(start));
-      }
-      Some(Item::DisplayMath(..)) => {
-        return Err(LatexTokenizerError::Unterminated("$$"));
-      }
-      None => {}
     }
-    assert!(self.stack.is_empty(), "bug");
     Ok(self.toks)
   }
 }
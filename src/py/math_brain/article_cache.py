@@ -0,0 +1,53 @@
+"""
+Module to cache parsed articles on disk.
+
+Entries are keyed on a hash of the raw page, the article class, and its
+PARSER_VERSION, so a changed page or a parser change simply misses the cache.
+Each entry is the article's to_json(), zlib-compressed, and is loaded with
+from_json(), which parses no html. Parse errors are cached too, so a page that
+does not parse is not re-parsed on every run.
+"""
+import hashlib
+import json
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from typing import Any
+import zlib
+
+from util.disk_cache import DiskCache
+
+DEFAULT_ARTICLE_CACHE_DIRECTORY = os.path.expanduser(f'~/mathbrain/article_cache')
+DEFAULT_MAX_BYTES = 256 << 20
+
+
+class ArticleCache(DiskCache):
+    # Prefix of entries that record a parse error rather than an article
+    error_magic = b'AERR'
+
+    def __init__(self,
+            cache_dir: str=DEFAULT_ARTICLE_CACHE_DIRECTORY,
+            max_bytes: int=DEFAULT_MAX_BYTES):
+        """
+        When the cache grows past max_bytes, the least recently used entries
+        are evicted.
+
+        The article classes cached must have a PARSER_VERSION, a constructor
+        taking the page, to_json(), and a static from_json().
+        """
+        super().__init__(cache_dir, max_bytes)
+
+    @staticmethod
+    def key(article_class: type, page: str) -> str:
+        h = hashlib.sha256(f'{article_class.__name__}\0{article_class.PARSER_VERSION}\0'.encode())
+        h.update(page.encode('utf-8', 'surrogatepass'))
+        return h.hexdigest()
+
+    def article(self, article_class: type, page: str) -> Any:
+        """
+        Returns article_class(page), parsing the page only on a cache miss. A
+        parse error is raised as a CachedError (see DiskCache.load()).
+        """
+        return self.load(ArticleCache.key(article_class, page), lambda: article_class(page),
+                lambda article: zlib.compress(json.dumps(article.to_json()).encode('utf-8')),
+                lambda data: article_class.from_json(json.loads(zlib.decompress(data))))
@@ -0,0 +1,68 @@
+"""
+Fetching and parsing of articles, shared by the parsers of each site (see
+wikipedia_parser.py and encyclopedia_of_math_parser.py).
+"""
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from typing import Any, Callable, List, Optional
+
+from math_brain.article_cache import ArticleCache
+from util.lru_cache import LruCache
+from util.web_cache import WebCache
+
+
+class ArticleParser:
+    def __init__(self, article_class: type, page_url: Callable[[str], str],
+            cache: Optional[WebCache]=None, article_cache_bytes: int=0,
+            parsed_cache: Optional[ArticleCache]=None):
+        """
+        Parses the page at page_url(url) of each article url into an
+        article_class.
+
+        If article_cache_bytes is nonzero, recently parsed articles are kept
+        in memory and returned again by later parses of the same url, as long
+        as the cache would serve their page without revalidating it (see
+        WebCache's ttl). Each is counted as the size of its page, which
+        understates its real size.
+
+        If parsed_cache is given, articles are saved there once parsed, and
+        loaded from there rather than parsed again, across runs. Pages that
+        fail to parse then raise a CachedError, whether cached or not.
+        """
+        self._article_class = article_class
+        self._page_url = page_url
+        self._cache = cache
+        if cache is None:
+            self._cache = WebCache()
+        self._articles = LruCache(article_cache_bytes) if article_cache_bytes else None
+        self._parsed_cache = parsed_cache
+
+    @property
+    def articles(self) -> Optional[LruCache]:
+        return self._articles
+
+    def parse(self, url) -> Any:
+        return self.parse_many([url])[0]
+
+    def parse_many(self, urls: List[str]) -> List[Any]:
+        """
+        Like [self.parse(url) for url in urls], but downloads concurrently.
+        """
+        keys = [self._cache.normalize(self._page_url(url)) for url in urls]
+        articles = {}
+        if self._articles is not None:
+            for key in keys:
+                cached = self._articles.get(key)  # (article, fetch_time of its page)
+                if cached is not None and self._cache.is_fresh(cached[1]):
+                    articles[key] = cached[0]
+        missing = list(dict.fromkeys(key for key in keys if key not in articles))
+        for key, entry in zip(missing, self._cache.fetch_entries(missing)):
+            if self._parsed_cache is None:
+                articles[key] = self._article_class(entry.text)
+            else:
+                articles[key] = self._parsed_cache.article(self._article_class, entry.text)
+            if self._articles is not None:
+                self._articles.put(key, (articles[key], entry.fetch_time),
+                        sys.getsizeof(entry.text))
+        return [articles[key] for key in keys]
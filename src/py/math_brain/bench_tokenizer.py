@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the LaTeX tokenizer engines on the corpus and on synthetic
+documents.
+
+Each engine (the Python Reference and Fast engines, plus, if src/latex_tokenizer
+has been built with cargo, the Rust tokenizer both through its Python binding
+and as a standalone binary) tokenizes each document group;
+chars/sec, tokens/sec and peak memory are reported per (engine, group). Every
+run is appended to a JSON-lines history file and compared with the previous
+run there, so regressions are visible run to run.
+
+All engines produce the same tokens, so a document that fails to tokenize
+fails under every engine. Failed documents are counted, and excluded from the
+rates.
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, NamedTuple, Tuple
+
+from math_brain.corpus import Corpus
+from math_brain.latex_tokenizer import Engine, LatexDocument, RustLatexTokenizer
+from util.bench_util import (CHARS_PER_SEC, FAILED, PEAK_MB, Column, append_run, last_run,
+        print_results, result_to_json)
+
+
+RUST_BENCH_BINARY = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', '..',
+    'latex_tokenizer', 'target', 'release', 'bench_tokenizer'))
+DEFAULT_HISTORY_PATH = os.path.expanduser(f'~/mathbrain/bench/tokenizer.jsonl')
+
+WORDS = ('let', 'triangle', 'circle', 'point', 'show', 'that', 'the', 'of', 'is', 'and',
+    'tangent', 'incentre', 'meets', 'line', 'segment', 'prove', 'equality', 'holds')
+COMMANDS = ('angle', 'triangle', 'cdot', 'geq', 'leq', 'alpha', 'omega', 'perp', 'parallel')
+
+
+def prose_document(rng: random.Random, size: int) -> str:
+    parts = []
+    n = 0
+    while n < size:
+        sentence = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 15)))
+        part = sentence.capitalize() + rng.choice(('. ', ', ', '; ', '.\n\n'))
+        parts.append(part)
+        n += len(part)
+    return ''.join(parts)
+
+
+def math_expression(rng: random.Random, scripts: bool=True) -> str:
+    atoms = []
+    for _ in range(rng.randint(2, 8)):
+        r = rng.random() if scripts else rng.choice((0, 0.6))
+        if r < 0.3:
+            atoms.append(f'\\{rng.choice(COMMANDS)} {rng.choice("ABCDPQ")}')
+        elif r < 0.5:
+            atoms.append(f'{rng.choice("xyz")}^{{{rng.randint(2, 99)}}}')
+        elif r < 0.6:
+            atoms.append(f'a_{{{rng.choice("ijk")}}}')
+        else:
+            atoms.append(rng.choice(('AB', 'PQ', 'XYZ', '2', '(x+y)', '|AB|')))
+    return f' {rng.choice("+-=<>")} '.join(atoms)
+
+
+def math_document(rng: random.Random, size: int) -> str:
+    parts = []
+    n = 0
+    while n < size:
+        if rng.random() < 0.2:
+            part = f'\n  $${math_expression(rng)}$$\n'
+        else:
+            part = f'{rng.choice(WORDS)} ${math_expression(rng)}$ '
+        parts.append(part)
+        n += len(part)
+    return ''.join(parts)
+
+
+def nested_document(rng: random.Random, size: int) -> str:
+    """
+    Display math containing deeply nested groups, alternating with \\[...\\]
+    blocks. No sub/superscripts inside groups or \\[...\\].
+    """
+    parts = []
+    n = 0
+    while n < size:
+        depth = rng.randint(10, 40)
+        inner = math_expression(rng, scripts=False)
+        for _ in range(depth):
+            inner = f'{{{inner} + {rng.choice("xyz")}}}'
+        if rng.random() < 0.5:
+            part = f'Then\n  $${inner}$$\n'
+        else:
+            part = f'Then\n  \\[ {math_expression(rng, scripts=False)} \\]\n'
+        parts.append(part)
+        n += len(part)
+    return ''.join(parts)
+
+
+def load_groups(scale: int, seed: int) -> Dict[str, List[Tuple[str, str]]]:
+    """
+    Returns {group: [(name, text), ...]}.
+    """
+    rng = random.Random(seed)
+    corpus = Corpus(index_path=None)
+    return {
+        'corpus': [(entry.path, entry.body) for entry in corpus.entries],
+        'prose': [('prose', prose_document(rng, scale))],
+        'math': [('math', math_document(rng, scale))],
+        'nested': [('nested', nested_document(rng, scale))],
+    }
+
+
+class Result(NamedTuple):
+    chars: int
+    tokens: int
+    seconds: float
+    failed: int
+    peak_bytes: int
+
+    def to_json(self) -> dict:
+        return result_to_json(self, ('chars', 'tokens'))
+
+
+def bench_python(engine: Engine, docs: List[Tuple[str, str]], iterations: int) -> Result:
+    chars = tokens = failed = 0
+    seconds = 0.0
+    for _, text in docs:
+        best = float('inf')
+        for _ in range(iterations):
+            start = time.perf_counter()
+            try:
+                doc = LatexDocument(text, engine)
+            except Exception:
+                doc = None
+            best = min(best, time.perf_counter() - start)
+        if doc is None:
+            failed += 1
+            continue
+        chars += len(text)
+        tokens += len(doc.toks)
+        seconds += best
+
+    # separate pass, since tracemalloc slows allocation down
+    peak_bytes = 0
+    for _, text in docs:
+        tracemalloc.start()
+        try:
+            doc = LatexDocument(text, engine)
+        except Exception:
+            pass
+        peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1])
+        doc = None
+        tracemalloc.stop()
+    return Result(chars, tokens, seconds, failed, peak_bytes)
+
+
+def bench_rust(docs: List[Tuple[str, str]], iterations: int) -> Result:
+    """
+    Runs the binary once per document, so that a panic (which aborts, in the
+    release profile) only fails that document.
+    """
+    chars = tokens = failed = peak_bytes = 0
+    seconds = 0.0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'doc.tex')
+        for _, text in docs:
+            with open(path, 'w', encoding='utf-8', errors='surrogatepass') as f:
+                f.write(text)
+            proc = subprocess.run([RUST_BENCH_BINARY, str(iterations), path],
+                    capture_output=True, text=True)
+            if proc.returncode != 0:
+                failed += 1
+                continue
+            for line in proc.stdout.splitlines():
+                fields = line.split('\t')
+                if fields[0] == 'peak_kb':
+                    peak_bytes = max(peak_bytes, int(fields[1]) * 1024)
+                elif fields[4] != 'ok':
+                    failed += 1
+                else:
+                    chars += int(fields[1])
+                    tokens += int(fields[2])
+                    seconds += float(fields[3])
+    return Result(chars, tokens, seconds, failed, peak_bytes)
+
+
+COLUMNS = [
+    CHARS_PER_SEC,
+    Column('tokens/s', 12, lambda r: f'{r["tokens_per_sec"]:,.0f}'),
+    PEAK_MB,
+    FAILED,
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', type=int, default=200000,
+            help='size in chars of each synthetic document (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=3,
+            help='best-of-N timing (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', action='append',
+            choices=[e.name for e in Engine] + ['RustBinary'],
+            help='engines to benchmark (default: all available)')
+    parser.add_argument('--history', default=DEFAULT_HISTORY_PATH,
+            help='JSON-lines file of past runs to append to and compare with '
+            '(default: %(default)s)')
+    args = parser.parse_args()
+
+    engines = args.engine or [e.name for e in Engine] + ['RustBinary']
+    if Engine.Rust.name in engines and not RustLatexTokenizer.available():
+        print(f'Skipping Rust: {RustLatexTokenizer.library_path} not built '
+                '(cargo build --release --lib in src/latex_tokenizer)')
+        engines.remove(Engine.Rust.name)
+    if 'RustBinary' in engines and not os.path.isfile(RUST_BENCH_BINARY):
+        print(f'Skipping RustBinary: {RUST_BENCH_BINARY} not built '
+                '(cargo build --release --bins in src/latex_tokenizer)')
+        engines.remove('RustBinary')
+
+    groups = load_groups(args.scale, args.seed)
+    results = {}
+    for engine in engines:
+        results[engine] = {}
+        for group, docs in groups.items():
+            if engine == 'RustBinary':
+                result = bench_rust(docs, args.iterations)
+            else:
+                result = bench_python(Engine[engine], docs, args.iterations)
+            results[engine][group] = result.to_json()
+
+    print_results(results, last_run(args.history), COLUMNS, 'engine')
+    append_run(args.history, {
+        'scale': args.scale,
+        'seed': args.seed,
+        'results': results,
+    })
+
+
+if __name__ == '__main__':
+    main()
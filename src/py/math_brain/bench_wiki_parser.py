@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Benchmarks parsing wikipedia articles, on the articles in the web cache and
+on synthetic ones.
+
+For each article group, reports the time to parse into a WikiArticle, both
+streaming (the default) and by building the whole html tree first, the part
+of that spent building the WikiTree, and the peak memory of each. Every run
+is appended to a JSON-lines history file and compared with the previous run
+there, so regressions are visible run to run.
+"""
+import argparse
+import os
+import random
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+from math_brain.wikipedia_parser import WikiArticle, WikiTree, stream_content
+from util.bench_util import (CHARS_PER_SEC, FAILED, PEAK_MB, Column, append_run, last_run,
+        print_results, result_to_json)
+from util.web_cache import DEFAULT_WEB_CACHE_DIRECTORY, STORE_DIRNAME, ShardedStore
+
+
+DEFAULT_HISTORY_PATH = os.path.expanduser(f'~/mathbrain/bench/wiki_parser.jsonl')
+WIKIPEDIA_KEY_PREFIX = 'en.wikipedia.org/wiki/'
+
+WORDS = ('circle', 'radius', 'tangent', 'the', 'of', 'is', 'chord', 'arc', 'centre', 'point')
+
+
+def math_span(rng: random.Random) -> str:
+    """
+    Like wikipedia's rendering of <math>: MathML, hidden, then an <img> whose
+    alt is the latex.
+    """
+    terms = ''.join(f'<msup><mi>x</mi><mn>{rng.randint(2, 9)}</mn></msup><mo>+</mo>'
+            for _ in range(rng.randint(1, 4)))
+    return ('<span class="mwe-math-element"><span class="mwe-math-mathml-inline" '
+            'style="display: none;"><math xmlns="http://www.w3.org/1998/Math/MathML"><semantics>'
+            f'<mrow>{terms}<mi>y</mi></mrow></semantics></math></span>'
+            f'<img class="mwe-math-fallback-image-inline" alt="x^{rng.randint(2, 9)} + y"/></span>')
+
+
+def paragraph(rng: random.Random) -> str:
+    words = [rng.choice(WORDS + ('<a href="/wiki/Arc">arc</a>', '<b>chord</b>', None))
+            for _ in range(rng.randint(10, 60))]
+    return '<p>' + ' '.join(w or math_span(rng) for w in words) + '</p>\n'
+
+
+def navbox(rng: random.Random, rows: int) -> str:
+    cells = ''.join(f'<tr><th>Group {i}</th><td><ul>' +
+            ''.join(f'<li><a href="/wiki/T{j}">Topic {j}</a></li>' for j in range(20)) +
+            '</ul></td></tr>' for i in range(rows))
+    return f'<div role="navigation" class="navbox"><table>{cells}</table></div>\n'
+
+
+def synthetic_article(rng: random.Random, sections: int) -> str:
+    parts = ['<html><head><title>Circle</title></head><body>',
+            '<div id="content"><h1 id="firstHeading">Circle</h1><div id="bodyContent">',
+            '<div id="mw-content-text"><div class="mw-parser-output">',
+            '<table class="infobox"><tr><td>Circle</td></tr></table>\n',
+            '<div id="toc" class="toc"><ul><li>1 History</li></ul></div>\n',
+            paragraph(rng), paragraph(rng)]
+    level = 2
+    for i in range(sections):
+        level = 2 if i % 4 == 0 else rng.choice((level, min(level + 1, 4)))
+        parts.append(f'<h{level}><span class="mw-headline">Section {i}</span>'
+                f'<span class="mw-editsection">[edit]</span></h{level}>\n')
+        parts.extend(paragraph(rng) for _ in range(rng.randint(1, 5)))
+        if rng.random() < 0.2:
+            parts.append('<div class="thumb tright"><div class="thumbinner">img</div></div>\n')
+    parts.append('<h2><span class="mw-headline">References</span></h2>\n<ul><li>r</li></ul>\n')
+    parts.append(navbox(rng, 30))
+    parts.append('</div></div></div></div>')
+    parts.append('<div id="mw-navigation"><ul>' +
+            ''.join(f'<li><a href="/x{i}">nav {i}</a></li>' for i in range(2000)) + '</ul></div>')
+    parts.append('<div id="footer">' + navbox(rng, 20) + '</div></body></html>')
+    return ''.join(parts)
+
+
+def cached_articles(cache_dir: str, limit: int) -> List[Tuple[str, str]]:
+    """
+    The <limit> largest wikipedia articles in the web cache, as [(key, html), ...].
+    """
+    store = None
+    sizes = {}
+    store_dir = os.path.join(cache_dir, STORE_DIRNAME)
+    if os.path.isdir(store_dir):  # ShardedStore() would create it
+        store = ShardedStore(store_dir)
+        sizes = {key: entry['size'] for key, entry in store.index().items()
+                if key.startswith(WIKIPEDIA_KEY_PREFIX)}
+    legacy_dir = os.path.join(cache_dir, WIKIPEDIA_KEY_PREFIX)
+    if os.path.isdir(legacy_dir):
+        for name in os.listdir(legacy_dir):
+            path = os.path.join(legacy_dir, name)
+            if os.path.isfile(path):
+                sizes.setdefault(WIKIPEDIA_KEY_PREFIX + name, os.path.getsize(path))
+    articles = []
+    for key in sorted(sizes, key=sizes.get, reverse=True)[:limit]:
+        entry = None if store is None else store.get(key)
+        if entry is not None:
+            articles.append((key, entry.text))
+        else:
+            with open(os.path.join(cache_dir, key)) as f:
+                articles.append((key, f.read()))
+    return articles
+
+
+def load_groups(cache_dir: str, limit: int, sections: int, seed: int
+        ) -> Dict[str, List[Tuple[str, str]]]:
+    """
+    Returns {group: [(name, html), ...]}, leaving out empty groups.
+    """
+    rng = random.Random(seed)
+    groups = {
+        'cached': cached_articles(cache_dir, limit),
+        'synthetic': [(f'synthetic{i}', synthetic_article(rng, sections)) for i in range(3)],
+    }
+    return {group: articles for group, articles in groups.items() if articles}
+
+
+class Result(NamedTuple):
+    chars: int
+    seconds: float
+    failed: int
+    peak_bytes: int
+
+    def to_json(self) -> dict:
+        return result_to_json(self)
+
+
+def bench(setup: Callable[[str], object], run: Callable[[object], object],
+        articles: List[Tuple[str, str]], iterations: int) -> Result:
+    """
+    Times run(setup(html)), best of <iterations>, summed over articles. Only
+    run() is timed, but it gets a fresh setup() every time, so that nothing
+    memoized on its argument (e.g. by cached_inside_text()) carries over.
+    """
+    chars = failed = peak_bytes = 0
+    seconds = 0.0
+    for _, text in articles:
+        try:
+            best = float('inf')
+            for _ in range(iterations):
+                arg = setup(text)
+                start = time.process_time()
+                run(arg)
+                best = min(best, time.process_time() - start)
+            # separate pass, since tracemalloc slows allocation down
+            arg = setup(text)
+            tracemalloc.start()
+            run(arg)
+            peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1])
+        except Exception:
+            failed += 1
+            continue
+        finally:
+            tracemalloc.stop()
+        chars += len(text)
+        seconds += best
+    return Result(chars, seconds, failed, peak_bytes)
+
+
+PHASES = {
+    'streaming': (lambda text: text, WikiArticle),
+    'full_tree': (lambda text: text, lambda text: WikiArticle(text, streaming=False)),
+    # only building the WikiTree, from already streamed content
+    'wiki_tree': (lambda text: stream_content(WikiArticle.fix_malformed_html(text)),
+            lambda content: WikiTree(*content)),
+}
+
+
+COLUMNS = [
+    CHARS_PER_SEC,
+    Column('ms', 9, lambda r: f'{1000 * r["seconds"]:.1f}'),
+    PEAK_MB,
+    FAILED,
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--cache-dir', default=DEFAULT_WEB_CACHE_DIRECTORY,
+            help='web cache to take articles from (default: %(default)s)')
+    parser.add_argument('--limit', type=int, default=20,
+            help='number of cached articles, largest first (default: %(default)s)')
+    parser.add_argument('--sections', type=int, default=200,
+            help='number of sections of each synthetic article (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=5,
+            help='best-of-N timing (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--history', default=DEFAULT_HISTORY_PATH,
+            help='JSON-lines file of past runs to append to and compare with '
+            '(default: %(default)s)')
+    args = parser.parse_args()
+
+    groups = load_groups(args.cache_dir, args.limit, args.sections, args.seed)
+    if 'cached' not in groups:
+        print(f'No wikipedia articles cached in {args.cache_dir}; only benchmarking synthetic ones')
+    results = {}
+    for phase, (setup, run) in PHASES.items():
+        results[phase] = {}
+        for group, articles in groups.items():
+            results[phase][group] = bench(setup, run, articles, args.iterations).to_json()
+
+    print_results(results, last_run(args.history), COLUMNS, 'phase', group_width=10)
+    append_run(args.history, {
+        'sections': args.sections,
+        'seed': args.seed,
+        'articles': {group: [name for name, _ in articles] for group, articles in groups.items()},
+        'results': results,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Lazy access to the corpus of problem files.
+
+Each file starts with a header in the format described in STYLE_GUIDE.md:
+
+    %% IMO 2011 C3
+    %% variant of: IMO 2011 Q2
+    %% transcribed by: Peter Jin
+
+Only headers are read to build the index, which is kept on disk and refreshed
+by stat()'ing files, so listing and filtering the corpus does not read file
+bodies. Bodies are loaded (and tokenized) on first access.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from typing import Dict, List, Optional
+
+from math_brain.latex_tokenizer import LatexDocument
+from math_brain.token_cache import TokenCache
+
+
+REPO_ROOT = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+DEFAULT_INDEX_PATH = os.path.expanduser(f'~/mathbrain/corpus_index.json')
+
+CORPUS_GLOBS = [
+    'imo/**/*.txt',
+    'ireland/**/*.txt',
+    'collections/**/*.tex',
+]
+
+# Not problem files
+CORPUS_EXCLUDES = {
+    'ireland/README.txt',
+}
+
+# Bump when the index format or header parsing changes
+INDEX_VERSION = 1
+
+
+def find_corpus_files(root: str=REPO_ROOT) -> List[str]:
+    """
+    Returns the paths of all corpus files under <root>, relative to it.
+    """
+    paths = set()
+    for pattern in CORPUS_GLOBS:
+        for path in glob.glob(os.path.join(root, pattern), recursive=True):
+            paths.add(os.path.relpath(path, root))
+    return sorted(paths - CORPUS_EXCLUDES)
+
+
+def decode(data: bytes) -> str:
+    """
+    Most of the corpus is utf-8, but the pdf->latex converted collections are
+    not, so fall back to latin-1, which decodes any byte sequence.
+    """
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def read_text(path: str) -> str:
+    with open(path, 'rb') as f:
+        return decode(f.read())
+
+
+class Header:
+    """
+    The %%-prefixed lines at the top of a corpus file.
+
+    A first line without a key is the title. Other lines are either key-value
+    pairs (e.g. "solution to: IMO 2020 Q1"), or free-form notes.
+    """
+    def __init__(self, title: Optional[str], fields: Dict[str, str], notes: List[str],
+            body_offset: int):
+        self._title = title
+        self._fields = fields
+        self._notes = notes
+        self._body_offset = body_offset
+
+    @staticmethod
+    def read(path: str) -> 'Header':
+        """
+        Reads only the header lines of the file at <path>.
+        """
+        title = None
+        fields = {}
+        notes = []
+        with open(path, 'rb') as f:
+            body_offset = 0
+            for raw_line in iter(f.readline, b''):
+                if not raw_line.startswith(b'%%'):
+                    break
+                first = body_offset == 0
+                body_offset += len(raw_line)
+                line = decode(raw_line)[2:].strip()
+                key, colon, value = line.partition(':')
+                if colon:
+                    fields[key.strip()] = value.strip()
+                elif first:
+                    title = line
+                else:
+                    notes.append(line)
+        return Header(title, fields, notes, body_offset)
+
+    @property
+    def title(self) -> Optional[str]:
+        return self._title
+
+    @property
+    def fields(self) -> Dict[str, str]:
+        return self._fields
+
+    @property
+    def notes(self) -> List[str]:
+        return self._notes
+
+    @property
+    def body_offset(self) -> int:
+        """
+        Byte offset of the content that follows the header.
+        """
+        return self._body_offset
+
+    def to_json(self) -> dict:
+        return {
+            'title': self.title,
+            'fields': self.fields,
+            'notes': self.notes,
+            'body_offset': self.body_offset,
+        }
+
+    @staticmethod
+    def from_json(obj: dict) -> 'Header':
+        return Header(obj['title'], obj['fields'], obj['notes'], obj['body_offset'])
+
+
+class CorpusEntry:
+    def __init__(self, root: str, path: str, header: Header):
+        self._root = root
+        self._path = path
+        self._header = header
+        self._body: Optional[str] = None
+        self._document: Optional[LatexDocument] = None
+
+    @property
+    def path(self) -> str:
+        """
+        Relative to the corpus root.
+        """
+        return self._path
+
+    @property
+    def header(self) -> Header:
+        return self._header
+
+    @property
+    def title(self) -> Optional[str]:
+        return self._header.title
+
+    @property
+    def body(self) -> str:
+        """
+        The content that follows the header, read on first access.
+        """
+        if self._body is None:
+            with open(os.path.join(self._root, self._path), 'rb') as f:
+                f.seek(self._header.body_offset)
+                self._body = decode(f.read())
+        return self._body
+
+    def document(self, cache: Optional[TokenCache]=None) -> LatexDocument:
+        """
+        The tokenized body, computed on first access.
+        """
+        if self._document is None:
+            if cache is None:
+                self._document = LatexDocument(self.body)
+            else:
+                self._document = cache.document(self.body)
+        return self._document
+
+
+class Corpus:
+    def __init__(self, root: str=REPO_ROOT, index_path: Optional[str]=DEFAULT_INDEX_PATH):
+        """
+        Loads the header index from index_path, re-reading the headers of
+        files whose size or mtime changed, and saves it back if anything did.
+        Pass index_path=None to skip the on-disk index.
+        """
+        self._root = root
+        self._index_path = index_path
+        self._entries: Dict[str, CorpusEntry] = {}
+        self._by_title: Dict[str, List[CorpusEntry]] = {}
+        self._load()
+
+    def _load(self):
+        old_files = {}
+        if self._index_path is not None and os.path.isfile(self._index_path):
+            with open(self._index_path) as f:
+                index = json.load(f)
+            if index.get('version') == INDEX_VERSION and index.get('root') == self._root:
+                old_files = index['files']
+
+        files = {}
+        for path in find_corpus_files(self._root):
+            st = os.stat(os.path.join(self._root, path))
+            stamp = [st.st_size, st.st_mtime_ns]
+            old = old_files.get(path)
+            if old is not None and old['stamp'] == stamp:
+                header = Header.from_json(old['header'])
+            else:
+                header = Header.read(os.path.join(self._root, path))
+            files[path] = {'stamp': stamp, 'header': header.to_json()}
+            entry = CorpusEntry(self._root, path, header)
+            self._entries[path] = entry
+            if entry.title is not None:
+                self._by_title.setdefault(entry.title, []).append(entry)
+
+        if self._index_path is not None and files != old_files:
+            os.makedirs(os.path.dirname(self._index_path), exist_ok=True)
+            index = {'version': INDEX_VERSION, 'root': self._root, 'files': files}
+            tmp_path = f'{self._index_path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self._index_path)
+
+    @property
+    def entries(self) -> List[CorpusEntry]:
+        return list(self._entries.values())
+
+    def __getitem__(self, path: str) -> CorpusEntry:
+        return self._entries[path]
+
+    def by_title(self, title: str) -> List[CorpusEntry]:
+        """
+        Titles need not be unique; e.g. a problem and its solution may share
+        one.
+        """
+        return self._by_title.get(title, [])
+
+    def targets(self, entry: CorpusEntry, key: str) -> List[CorpusEntry]:
+        """
+        Entries titled by <entry>'s <key> field, e.g. the problems that a
+        solution is a 'solution to'.
+        """
+        title = entry.header.fields.get(key)
+        return [] if title is None else self.by_title(title)
+
+    def referrers(self, entry: CorpusEntry, key: str) -> List[CorpusEntry]:
+        """
+        Entries whose <key> field names <entry>'s title, e.g. the solutions to
+        a problem.
+        """
+        return [e for e in self._entries.values()
+                if entry.title is not None and e.header.fields.get(key) == entry.title]
+
+    def filter(self, fields: Dict[str, str]) -> List[CorpusEntry]:
+        """
+        Entries whose header has all of the given fields, e.g.
+        {'transcribed by': 'Peter Jin'}.
+        """
+        return [e for e in self._entries.values()
+                if all(e.header.fields.get(k) == v for k, v in fields.items())]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lists corpus files and their headers.')
+    parser.add_argument('--root', default=REPO_ROOT, help='corpus root (default: %(default)s)')
+    parser.add_argument('--index', default=DEFAULT_INDEX_PATH,
+            help='header index path (default: %(default)s)')
+    parser.add_argument('--field', action='append', default=[], metavar='KEY=VALUE',
+            help='only list files whose header has this field (repeatable)')
+    args = parser.parse_args()
+
+    fields = {}
+    for field in args.field:
+        key, eq, value = field.partition('=')
+        if not eq:
+            parser.error(f'Invalid --field: "{field}"')
+        fields[key] = value
+
+    corpus = Corpus(args.root, args.index)
+    for entry in corpus.filter(fields):
+        print(f'{entry.path}: {entry.title}')
+        for key, value in entry.header.fields.items():
+            targets = ', '.join(e.path for e in corpus.targets(entry, key))
+            print(f'  {key}: {value}' + (f' -> {targets}' if targets else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Crawls wikipedia or encyclopediaofmath.org: parses the articles on a list of
+topics, and, to a given depth, the articles they link to, and writes each
+parsed article to an output directory, as JSON.
+
+Pages are downloaded through a WebCache, concurrently, with failed downloads
+retried with exponential backoff; parsing, which is CPU-bound, runs in a
+process pool meanwhile.
+
+Every topic finished, or failed, is logged to <out>/crawl.jsonl, so a crawl
+that is interrupted and rerun with the same arguments picks up where it left
+off: topics logged as parsed are not downloaded or parsed again, though the
+links logged for them are still followed. Failed topics are retried.
+"""
+import argparse
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+import http.client
+import json
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import tempfile
+import time
+from typing import Any, Callable, Deque, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+import urllib.error
+import urllib.parse
+
+from math_brain import encyclopedia_of_math_parser, wikipedia_parser
+from util.web_cache import DEFAULT_WEB_CACHE_DIRECTORY, WebCache
+
+DEFAULT_CRAWL_DIRECTORY = os.path.expanduser(f'~/mathbrain/crawl')
+LOG_FILENAME = 'crawl.jsonl'
+
+
+class Site(NamedTuple):
+    name: str
+    # topic -> url of its article
+    article_url: Callable[[str], str]
+    # article url -> url of the page to download and parse
+    page_url: Callable[[str], str]
+    # page -> article, with links() and to_json()
+    parse: Callable[[str], Any]
+
+
+SITES = {site.name: site for site in (
+    Site('wikipedia', wikipedia_parser.article_url, lambda url: url, wikipedia_parser.WikiArticle),
+    Site('eom', encyclopedia_of_math_parser.article_url, encyclopedia_of_math_parser.to_edit_page,
+            encyclopedia_of_math_parser.EncyclopediaOfMathArticle),
+)}
+
+
+def normalize_topic(topic: str) -> str:
+    """
+    'Pythagorean theorem' or 'Pythagorean%20theorem' -> 'Pythagorean_theorem'
+    """
+    return urllib.parse.unquote(topic).strip().replace(' ', '_')
+
+
+class ArticleStore:
+    """
+    Parsed articles, each at <out_dir>/<site>/<quoted topic>.json, and the
+    crawl log, <out_dir>/crawl.jsonl, with one JSON object per topic finished,
+    the later of two lines for the same url winning.
+    """
+    def __init__(self, out_dir: str):
+        self._out_dir = out_dir
+        self._log_path = os.path.join(out_dir, LOG_FILENAME)
+        os.makedirs(out_dir, exist_ok=True)
+
+    @property
+    def out_dir(self) -> str:
+        return self._out_dir
+
+    def path(self, site: str, topic: str) -> str:
+        return os.path.join(self._out_dir, site, urllib.parse.quote(topic, safe='') + '.json')
+
+    def write(self, site: str, topic: str, record: dict):
+        path = self.path(site, topic)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write-then-rename, so that an interrupted crawl never leaves a partial article
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+
+    def read(self, site: str, topic: str) -> dict:
+        with open(self.path(site, topic)) as f:
+            return json.load(f)
+
+    def log(self, entry: dict):
+        with open(self._log_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def logged(self) -> Dict[str, dict]:
+        """
+        {url: the latest log entry for it}
+        """
+        entries = {}
+        if os.path.isfile(self._log_path):
+            with open(self._log_path) as f:
+                for line in f:
+                    if line.endswith('\n'):  # skip a line cut short by a crash
+                        entry = json.loads(line)
+                        entries[entry['url']] = entry
+        return entries
+
+
+class ParseResult(NamedTuple):
+    num_chars: int
+    links: List[str]
+    seconds: float
+    error: Optional[str]
+
+
+def parse_page(site_name: str, url: str, topic: str, page: str, out_dir: str) -> ParseResult:
+    """
+    Parses page, the page of topic, and writes the article to out_dir. Runs
+    in a worker process.
+    """
+    start = time.perf_counter()
+    links = []
+    error = None
+    try:
+        article = SITES[site_name].parse(page)
+        links = [normalize_topic(link) for link in article.links()]
+        record = {'url': url, 'topic': topic, 'article': article.to_json()}
+        ArticleStore(out_dir).write(site_name, topic, record)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    return ParseResult(len(page), links, time.perf_counter() - start, error)
+
+
+def is_transient(e: Exception) -> bool:
+    """
+    Whether a download that failed with e might succeed if retried.
+    """
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code == 429 or e.code >= 500
+    return isinstance(e, (OSError, http.client.HTTPException))
+
+
+def fetch_with_retries(cache: WebCache, urls: Sequence[str], retries: int, backoff: float
+        ) -> List:
+    """
+    Like cache.fetch_many(urls, return_exceptions=True), but retries
+    downloads that fail transiently up to <retries> times, after waiting
+    backoff, 2*backoff, 4*backoff... seconds.
+    """
+    results = cache.fetch_many(urls, return_exceptions=True)
+    for attempt in range(retries):
+        failed = [i for i, result in enumerate(results)
+                if isinstance(result, Exception) and is_transient(result)]
+        if not failed:
+            break
+        time.sleep(backoff * 2**attempt)
+        retried = cache.fetch_many([urls[i] for i in failed], return_exceptions=True)
+        for i, result in zip(failed, retried):
+            results[i] = result
+    return results
+
+
+class Crawl:
+    def __init__(self, site: Site, cache: WebCache, store: ArticleStore, depth: int=0,
+            jobs: Optional[int]=None, batch_size: int=64, retries: int=3, backoff: float=1.0):
+        """
+        Follows links from the articles of the topics given to run() up to
+        depth links away. Downloads batch_size pages at a time, parsing them
+        on jobs processes.
+        """
+        self._site = site
+        self._cache = cache
+        self._store = store
+        self._depth = depth
+        self._jobs = jobs or os.cpu_count()
+        self._batch_size = batch_size
+        self._retries = retries
+        self._backoff = backoff
+
+        self._logged = store.logged()
+        # topics waiting to be downloaded, with their distance from the given ones
+        self._frontier: Deque[Tuple[str, int]] = deque()
+        self._seen = set()  # urls
+        self.num_parsed = 0
+        self.num_skipped = 0  # parsed by an earlier run
+        self.failed: List[str] = []
+
+    def run(self, topics: Sequence[str]):
+        self._frontier.extend((normalize_topic(topic), 0) for topic in topics)
+        # bounds the pages held in memory while waiting to be parsed
+        max_pending = 2 * self._jobs + self._batch_size
+        pending: Dict[Future, Tuple[str, str, int]] = {}  # -> (url, topic, depth)
+        with ProcessPoolExecutor(max_workers=self._jobs) as executor:
+            while self._frontier or pending:
+                batch = list(self._next_batch())
+                if batch:
+                    pages = fetch_with_retries(self._cache,
+                            [self._site.page_url(url) for url, _, _ in batch],
+                            self._retries, self._backoff)
+                    for (url, topic, depth), page in zip(batch, pages):
+                        if isinstance(page, Exception):
+                            self._finish(url, topic, depth, ParseResult(0, [], 0.0,
+                                    f'{type(page).__name__}: {page}'))
+                            continue
+                        future = executor.submit(parse_page, self._site.name, url, topic, page,
+                                self._store.out_dir)
+                        pending[future] = (url, topic, depth)
+                if not pending:
+                    continue
+                # only wait for a parse if there is nothing to download meanwhile
+                block = not self._frontier or len(pending) >= max_pending
+                done, _ = wait(pending, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._finish(*pending.pop(future), future.result())
+
+    def _next_batch(self) -> Iterator[Tuple[str, str, int]]:
+        """
+        Yields up to batch_size (url, topic, depth) to download, skipping
+        topics already seen, and following the logged links of those parsed
+        by an earlier run instead.
+        """
+        n = 0
+        while self._frontier and n < self._batch_size:
+            topic, depth = self._frontier.popleft()
+            url = self._cache.normalize(self._site.article_url(topic))
+            if url in self._seen:
+                continue
+            self._seen.add(url)
+            entry = self._logged.get(url)
+            if entry is not None and entry['error'] is None:
+                self.num_skipped += 1
+                self._follow(entry['links'], depth)
+                continue
+            n += 1
+            yield url, topic, depth
+
+    def _follow(self, links: List[str], depth: int):
+        if depth < self._depth:
+            self._frontier.extend((link, depth + 1) for link in links)
+
+    def _finish(self, url: str, topic: str, depth: int, result: ParseResult):
+        self._store.log({'url': url, 'topic': topic, 'depth': depth, 'error': result.error,
+                'links': result.links, 'time': time.time()})
+        if result.error:
+            self.failed.append(topic)
+        else:
+            self.num_parsed += 1
+            self._follow(result.links, depth)
+
+        status = 'FAIL' if result.error else 'ok'
+        num_done = self.num_parsed + self.num_skipped + len(self.failed)
+        print(f'{status:4} [{num_done}/{len(self._seen)}] {topic}: {result.num_chars} chars, '
+                f'{len(result.links)} links, {1000 * result.seconds:.1f}ms')
+        if result.error:
+            print(f'     {result.error}')
+
+
+def read_topics(path: str) -> List[str]:
+    """
+    One topic per line, skipping blank lines and # comments.
+    """
+    with open(path) as f:
+        lines = [line.partition('#')[0].strip() for line in f]
+    return [line for line in lines if line]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('topics', nargs='*', help='topics to crawl, e.g. Circle')
+    parser.add_argument('--topics-file', metavar='FILE',
+            help='file of topics to crawl, one per line, # starting a comment')
+    parser.add_argument('--site', choices=list(SITES), default='wikipedia',
+            help='(default: %(default)s)')
+    parser.add_argument('--depth', type=int, default=0,
+            help='follow links this many articles away from the given topics '
+            '(default: %(default)s)')
+    parser.add_argument('--out', default=DEFAULT_CRAWL_DIRECTORY,
+            help='directory to write parsed articles and the crawl log to (default: %(default)s)')
+    parser.add_argument('--cache-dir', default=DEFAULT_WEB_CACHE_DIRECTORY,
+            help='web cache (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+            help='number of parsing processes (default: %(default)s)')
+    parser.add_argument('--max-workers', type=int, default=16,
+            help='number of download threads (default: %(default)s)')
+    parser.add_argument('--max-per-host', type=int, default=4,
+            help='concurrent downloads per host (default: %(default)s)')
+    parser.add_argument('--requests-per-second', type=float,
+            help='per-host rate limit (default: none)')
+    parser.add_argument('--batch-size', type=int, default=64,
+            help='pages downloaded at a time (default: %(default)s)')
+    parser.add_argument('--retries', type=int, default=3,
+            help='retries of a download that fails transiently (default: %(default)s)')
+    parser.add_argument('--backoff', type=float, default=1.0,
+            help='seconds to wait before the first retry, doubling after each '
+            '(default: %(default)s)')
+    args = parser.parse_args()
+
+    topics = list(args.topics)
+    if args.topics_file:
+        topics.extend(read_topics(args.topics_file))
+    if not topics:
+        parser.error('no topics given')
+
+    cache = WebCache(args.cache_dir, max_workers=args.max_workers,
+            max_per_host=args.max_per_host, requests_per_second=args.requests_per_second)
+    crawl = Crawl(SITES[args.site], cache, ArticleStore(args.out), args.depth, args.jobs,
+            args.batch_size, args.retries, args.backoff)
+    start = time.perf_counter()
+    try:
+        crawl.run(topics)
+    finally:
+        cache.close()
+    elapsed = time.perf_counter() - start
+
+    print(f'{crawl.num_parsed} parsed, {crawl.num_skipped} already parsed, '
+            f'{len(crawl.failed)} failed, in {elapsed:.2f}s')
+    if crawl.failed:
+        print(f'errors: n={len(crawl.failed)} {crawl.failed}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,21 @@
 Does a best-effort parse of a encyclopediaofmath.org article.
 """
 import os
+import re
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from typing import Dict, List, Optional
+import urllib.parse
 import xml.etree.ElementTree as ET
 
+from math_brain.article_cache import ArticleCache
+from math_brain.article_parser import ArticleParser
 from util.web_cache import WebCache
-from util.xml_util import get_inside_text, get_node
+from util.xml_util import NodeIndex, get_inside_text
+
+
+# [[Triangle|triangle]] in the wiki source links to the article Triangle
+ARTICLE_LINK_REGEX = re.compile(r'\[\[([^\[\]|#]+)')
 
 
 class ExtraSection:
@@ -33,6 +41,16 @@ class ExtraSection:
     def text(self) -> str:
         return self._text
 
+    def to_json(self) -> dict:
+        return {'title': self.title, 'text': self.text}
+
+    @staticmethod
+    def from_json(d: dict) -> 'ExtraSection':
+        section = ExtraSection(d['title'])
+        section._lines = None
+        section._text = d['text']
+        return section
+
     def dump(self):
         print(f'** {self.title} **')
         print(self.text)
@@ -45,6 +63,10 @@ class EncyclopediaOfMathArticle:
     The implementation of this class takes advantage of the very specific
     format of each article.
     """
+    # Bump whenever the article parsed from some page may change, so that
+    # serialized articles (see article_cache.py) are invalidated.
+    PARSER_VERSION = 1
+
     @staticmethod
     def fix_malformed_html(text):
         """
@@ -60,22 +82,18 @@ class EncyclopediaOfMathArticle:
     def __init__(self, html_text: str):
         html_text = EncyclopediaOfMathArticle.fix_malformed_html(html_text)
         tree = ET.fromstring(html_text)
-        body = get_node(tree, 'body')
-        outer_shell = get_node(body, 'div', {'id': 'OuterShell'})
-        inner_shell = get_node(outer_shell, 'div', {'id': 'InnerShell'})
-        content_shell = get_node(inner_shell, 'div', {'id': 'ContentShell'})
-        content = get_node(content_shell, 'div', {'id': 'content'})
-        inner_content = get_node(content, 'div', {'id': 'InnerContent'})
-
-        first_heading = get_node(inner_content, 'h1', {'id': 'firstHeading'})
+        nodes = NodeIndex(tree)
+        inner_content = nodes.get_path(
+                'body/div#OuterShell/div#InnerShell/div#ContentShell/div#content/div#InnerContent')
+
+        first_heading = nodes.get_node(inner_content, 'h1', {'id': 'firstHeading'})
         heading_text = get_inside_text(first_heading)
         heading_prefix = 'View source for '
         assert heading_text.startswith(heading_prefix), heading_text
         topic = heading_text[len(heading_prefix):]
 
-        body_content = get_node(inner_content, 'div', {'id': 'bodyContent'})
-        mw_content_text = get_node(body_content, 'div', {'id': 'mw-content-text'})
-        text_area = get_node(mw_content_text, 'textarea', {'id': 'wpTextbox1'})
+        text_area = nodes.get_path('div#bodyContent/div#mw-content-text/textarea#wpTextbox1',
+                inner_content)
         complete_text = get_inside_text(text_area)
 
         # text can contain extra sections that start with ==== (references, comments)
@@ -112,6 +130,37 @@ class EncyclopediaOfMathArticle:
     def extra_sections(self) -> List[ExtraSection]:
         return self._extra_sections
 
+    def links(self) -> List[str]:
+        """
+        The topics of the articles linked to from the main text, e.g.
+        'Triangle' for [[Triangle|triangle]], in order, without repeats.
+        """
+        topics = []
+        for match in ARTICLE_LINK_REGEX.finditer(self.main_text):
+            topic = match.group(1).strip().replace(' ', '_')
+            if topic and ':' not in topic:  # not e.g. [[File:...]]
+                topics.append(topic)
+        return list(dict.fromkeys(topics))
+
+    def to_json(self) -> dict:
+        return {
+            'topic': self.topic,
+            'main_text': self.main_text,
+            'extra_sections': [section.to_json() for section in self.extra_sections],
+        }
+
+    @staticmethod
+    def from_json(d: dict) -> 'EncyclopediaOfMathArticle':
+        """
+        The inverse of to_json(), without parsing any html.
+        """
+        article = EncyclopediaOfMathArticle.__new__(EncyclopediaOfMathArticle)
+        article._topic = d['topic']
+        article._main_text = d['main_text']
+        article._extra_sections = [ExtraSection.from_json(section)
+                for section in d['extra_sections']]
+        return article
+
     def dump(self, include_extra_sections=False):
         print(f'* {self.topic} *')
         print('')
@@ -122,6 +171,13 @@ class EncyclopediaOfMathArticle:
                 section.dump()
 
 
+def article_url(topic: str) -> str:
+    """
+    'Triangle' -> 'https://encyclopediaofmath.org/wiki/Triangle'
+    """
+    return f'https://encyclopediaofmath.org/wiki/{urllib.parse.quote(topic, safe="")}'
+
+
 def to_edit_page(url: str) -> str:
     assert url.find('encyclopediaofmath.org') != -1
     tokens = url.split('/')
@@ -138,21 +194,18 @@ def to_edit_page(url: str) -> str:
     return f'https://encyclopediaofmath.org/index.php?title={topic}&action=edit'
 
 
-class EncyclopediaOfMathParser:
-    def __init__(self, cache: Optional[WebCache]=None):
-        self._cache = cache
-        if cache is None:
-            self._cache = WebCache()
-
-    def parse(self, url) -> EncyclopediaOfMathArticle:
+class EncyclopediaOfMathParser(ArticleParser):
+    """
+    Parses articles such as https://encyclopediaofmath.org/wiki/Triangle,
+    from their edit page, which contains the latex source.
+    """
+    def __init__(self, cache: Optional[WebCache]=None, article_cache_bytes: int=0,
+            parsed_cache: Optional[ArticleCache]=None):
         """
-        Example url: https://encyclopediaofmath.org/wiki/Triangle
-
-        The edit page contains the latex source.
+        See ArticleParser.
         """
-        url = to_edit_page(url)
-        text = self._cache.html_request(url)
-        return EncyclopediaOfMathArticle(text)
+        super().__init__(EncyclopediaOfMathArticle, to_edit_page, cache, article_cache_bytes,
+                parsed_cache)
 
 
 def main():
@@ -163,9 +216,9 @@ def main():
         pass
 
     topic = sys.argv[1].lower()
-    parser = EncyclopediaOfMathParser()
+    parser = EncyclopediaOfMathParser(parsed_cache=ArticleCache())
     if not topic.startswith('http'):
-        url = f'https://encyclopediaofmath.org/wiki/{topic}'
+        url = article_url(topic)
     else:
         url = topic
     parser.parse(url).dump()
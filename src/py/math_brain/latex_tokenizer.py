@@ -9,19 +9,30 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 Adapted from Peter Jin's tokenizer.rs
 """
 from abc import ABCMeta, abstractmethod
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+import codecs
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+import ctypes
 from enum import Enum, auto
+from itertools import accumulate
+import json
+import mmap
 import os
+import re
+import struct
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from typing import List, Optional, Union
+from typing import IO, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Type, Union
 
-from util.py_util import char, char_repr, type_str
+from util.py_util import char, type_str
 
 
-DEBUG = False
-def debug_print(x):
-    if DEBUG:
-        print(x)
+# Bump whenever the tokens produced for some source may change, so that
+# serialized TokenStream's (see token_cache.py) are invalidated.
+TOKENIZER_VERSION = 1
 
 
 class Mode(Enum):
@@ -53,6 +64,47 @@ def to_str_buf(s: StrBufLike) -> StrBuf:
 
 
 class LatexToken:
+    """
+    Tokens compare equal, and hash alike, when they have the same type and
+    text, regardless of their spans.
+
+    Payload-free tokens are singletons: e.g. LatexTokens.Space() always
+    returns the same object. The exception is tokens materialized from a
+    TokenStream (see with_span()), which each carry their own span.
+    """
+    # [start, end) source offsets; set on tokens materialized from a TokenStream
+    start: Optional[int] = None
+    end: Optional[int] = None
+
+    def __init_subclass__(cls):
+        if cls.__init__ is object.__init__:  # no payload
+            cls._instance = object.__new__(cls)
+            cls.__new__ = lambda cls: cls._instance
+            cls.__reduce__ = LatexToken._reduce_singleton
+
+    @classmethod
+    def with_span(cls, start: int, end: int) -> 'LatexToken':
+        tok = object.__new__(cls)
+        tok.start = start
+        tok.end = end
+        return tok
+
+    def _reduce_singleton(self):
+        """
+        __reduce__() of payload-free tokens, for pickle and copy. By default,
+        they would call __new__(), which returns the singleton, and then set
+        the span of the token copied on it.
+        """
+        if self.start is None:
+            return type(self), ()
+        return type(self).with_span, (self.start, self.end)
+
+    def __eq__(self, other):
+        return type(self) is type(other)
+
+    def __hash__(self):
+        return hash(type(self))
+
     def __str__(self):
         return f'[{type_str(self)}]'
 
@@ -96,19 +148,16 @@ class LatexTokenizer:
             self.commit(LatexTokens.Text(buf))
 
     def commit(self, token: LatexToken):
-        debug_print(f'Commit: {token}')
         assert isinstance(token, LatexToken)
         self.toks.append(token)
 
     def enqueue(self, item: Item):
-        debug_print(f'Enqueue: {item}')
         self.stack.append(item)
 
     def pop(self) -> Item:
         return self.stack.pop()
 
     def tokenize_math_char(self, math_item: 'BufItem', c: char):
-        debug_print(f'tokenize_math_char({math_item}, {char_repr(c)})')
         if c in "+-=<>.,?;:[]()^_{}'":
             self.commit_text(''.join(math_item.buf))
             self.commit(LatexTokens.from_char(c, True))
@@ -129,28 +178,116 @@ class LatexTokenizer:
             self.enqueue(math_item)
 
     def tokenize_char(self, c: char):
-        debug_print(f'tokenize_char({char_repr(c)})')
         while self.stack:
             item: Item = self.stack.pop()
-            debug_print(f'stack: {item} {char_repr(c)}')
             if not item.handle(self, c):
                 break
 
-    def tokenize(self, source: str):
-        debug_print('Reading source')
-        for c in source:
-            self.tokenize_char(c)
-        debug_print('Popping remaining stack')
+    def tokenize_end(self):
         while self.stack:
             item = self.stack.pop()
-            debug_print(f'stack: {item}')
             for tok in item.to_toks():
                 self.commit(tok)
 
+    def tokenize(self, source: str):
+        for c in source:
+            self.tokenize_char(c)
+        self.tokenize_end()
+
+    def iter_tokens(self, chunks: Iterable[str]) -> Iterator[LatexToken]:
+        """
+        Like tokenize(), but reads the source in chunks and yields tokens as
+        soon as they are committed, so only the unresolved stack is held in
+        memory.
+        """
+        for chunk in chunks:
+            try:
+                for c in chunk:
+                    self.tokenize_char(c)
+            finally:
+                yield from self.toks
+                self.toks = []
+        try:
+            self.tokenize_end()
+        finally:
+            yield from self.toks
+            self.toks = []
+
+
+class TraceEvent(NamedTuple):
+    event: str  # 'char', 'pop', 'enqueue', 'commit' or 'end'
+    index: int  # of the source char being tokenized
+    char: Optional[char]
+    item: Optional[str]  # the Item popped/enqueued, or the LatexToken committed
+    stack: Optional[List[str]]  # for 'char' events, the stack before handling it
+
+
+class Tracer:
+    def __init__(self, f: Optional[IO[str]]=None):
+        """
+        Collects TraceEvent's in self.events, or, if f is given, writes them
+        to it as JSON lines instead.
+        """
+        self.f = f
+        self.events: List[TraceEvent] = []
+
+    def emit(self, event: TraceEvent):
+        if self.f is None:
+            self.events.append(event)
+        else:
+            self.f.write(json.dumps(event._asdict()) + '\n')
+
+
+class TracingLatexTokenizer(LatexTokenizer):
+    """
+    A LatexTokenizer that reports every step of its state machine to a
+    Tracer. Tracing lives in this subclass so that LatexTokenizer itself pays
+    nothing for it.
+    """
+    def __init__(self, tracer: Tracer):
+        super().__init__()
+        self.tracer = tracer
+        self.index = 0
+        self.c: Optional[char] = None
+
+    def emit(self, event: str, item=None, stack: Optional[List[str]]=None):
+        self.tracer.emit(TraceEvent(event, self.index, self.c,
+            None if item is None else str(item), stack))
+
+    def commit(self, token: LatexToken):
+        self.emit('commit', token)
+        super().commit(token)
+
+    def enqueue(self, item: Item):
+        self.emit('enqueue', item)
+        super().enqueue(item)
+
+    def tokenize_char(self, c: char):
+        self.c = c
+        self.emit('char', stack=[str(item) for item in self.stack])
+        while self.stack:
+            item: Item = self.stack.pop()
+            self.emit('pop', item)
+            if not item.handle(self, c):
+                break
+        self.index += 1
+
+    def tokenize_end(self):
+        self.c = None
+        self.emit('end', stack=[str(item) for item in self.stack])
+        super().tokenize_end()
+
 
 class LatexTokenWithText(LatexToken):
     def __init__(self, buf: StrBufLike):
-        self.text = ''.join(to_str_buf(buf))
+        # interned, since the same commands and symbols recur throughout a corpus
+        self.text = sys.intern(''.join(to_str_buf(buf)))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.text == other.text
+
+    def __hash__(self):
+        return hash((type(self), self.text))
 
     def __str__(self):
         text = self.text.replace('\n', '\\n')
@@ -411,18 +548,994 @@ class Items:
         return Items.char_map[c]()
 
 
+class MappedSource:
+    """
+    A memory-mapped file, standing in for the str source of a TokenStream
+    (see LatexDocument.from_file()). Offsets into it are byte offsets, and
+    slicing decodes just the slice.
+    """
+    def __init__(self, path: str, encoding: str='utf-8'):
+        """
+        <encoding> must be utf-8 or latin-1.
+        """
+        self.path = path
+        self.encoding = encoding
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.map: Union[mmap.mmap, bytes] = mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.map = b''  # can't map an empty file
+
+    def __len__(self) -> int:
+        return len(self.map)
+
+    def __getitem__(self, i: slice) -> str:
+        return self.map[i].decode(self.encoding)
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+
+
+class TokenStream(Sequence):
+    """
+    A compact sequence of LatexToken's.
+
+    Token kinds are stored as small ints in one array, and text payloads as
+    (offset, length) slices into the source in two more. Payload-free tokens
+    have length 0 and an offset just past the source chars they consumed.
+
+    A fourth array holds the start of each token's source span. Every payload
+    is a suffix of its span (e.g. math-mode "\\frac" has payload "frac"), so
+    the span is [start, offset + length).
+
+    Indexing materializes a LatexToken object on demand; nothing is cached, so
+    callers that need objects repeatedly should hold onto them (or call
+    to_list()).
+    """
+    kind_classes = (
+        LatexTokens.Text,
+        LatexTokens.Number,
+        LatexTokens.Command,
+        LatexTokens.Symbol,
+        LatexTokens.Punct,
+        LatexTokens.LBrack,
+        LatexTokens.RBrack,
+        LatexTokens.LCurly,
+        LatexTokens.RCurly,
+        LatexTokens.LParen,
+        LatexTokens.RParen,
+        LatexTokens.LQuote,
+        LatexTokens.RQuote,
+        LatexTokens.LDQuote,
+        LatexTokens.RDQuote,
+        LatexTokens.VBar,
+        LatexTokens.Space,
+        LatexTokens.Super,
+        LatexTokens.Sub,
+        LatexTokens.LGroup,
+        LatexTokens.RGroup,
+        LatexTokens.StartInlineMath,
+        LatexTokens.EndInlineMath,
+        LatexTokens.StartDisplayMath,
+        LatexTokens.EndDisplayMath,
+    )
+    kind_of = {cls: k for k, cls in enumerate(kind_classes)}
+    kind_of_name = {cls.__name__: k for k, cls in enumerate(kind_classes)}
+    has_text = tuple(issubclass(cls, LatexTokenWithText) for cls in kind_classes)
+
+    def __init__(self, source: str):
+        self.source = source
+        self.kinds = array('B')
+        self.starts = array('I')
+        self.offsets = array('I')
+        self.lengths = array('I')
+        self._line_starts: Optional[array] = None
+
+    def append(self, kind: int, start: int, offset: int, length: int):
+        self.kinds.append(kind)
+        self.starts.append(start)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def kind(self, i: int) -> Type[LatexToken]:
+        return TokenStream.kind_classes[self.kinds[i]]
+
+    def text(self, i: int) -> str:
+        """
+        The text payload of the i'th token, or '' for payload-free tokens.
+        """
+        offset = self.offsets[i]
+        return self.source[offset:offset + self.lengths[i]]
+
+    def span(self, i: int) -> Tuple[int, int]:
+        """
+        The [start, end) source offsets of the i'th token.
+        """
+        return self.starts[i], self.offsets[i] + self.lengths[i]
+
+    def span_text(self, i: int) -> str:
+        start, end = self.span(i)
+        return self.source[start:end]
+
+    def line_col(self, offset: int) -> Tuple[int, int]:
+        """
+        Maps a source offset to a 1-based (line, column) pair. The line index
+        is built on first use.
+        """
+        if self._line_starts is None:
+            self._line_starts = array('I', [0])
+            if isinstance(self.source, MappedSource):
+                newlines = re.finditer(b'\n', self.source.map)
+            else:
+                newlines = re.finditer('\n', self.source)
+            self._line_starts.extend(m.end() for m in newlines)
+        line = bisect_right(self._line_starts, offset)
+        return line, offset - self._line_starts[line - 1] + 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        kind = self.kinds[i]
+        cls = TokenStream.kind_classes[kind]
+        if TokenStream.has_text[kind]:
+            tok = cls(self.text(i))
+            tok.start, tok.end = self.span(i)
+            return tok
+        return cls.with_span(*self.span(i))
+
+    def to_list(self) -> List[LatexToken]:
+        return self[:]
+
+    def text_mode_start(self, k: int, kinds: bytes) -> int:
+        """
+        Returns k if the k'th token begins in text mode, and otherwise the
+        index of the StartInlineMath/StartDisplayMath token of the math that
+        contains it. <kinds> is self.kinds.tobytes(), which lets the search
+        run at C speed.
+        """
+        K = TokenStream.kind_of_name
+        last_start = max(kinds.rfind(K['StartInlineMath'], 0, k),
+                kinds.rfind(K['StartDisplayMath'], 0, k))
+        last_end = max(kinds.rfind(K['EndInlineMath'], 0, k),
+                kinds.rfind(K['EndDisplayMath'], 0, k))
+        return last_start if last_start > last_end else k
+
+    # magic, TOKENIZER_VERSION, token count
+    header = struct.Struct('<4sII')
+    magic = b'LTOK'
+
+    def to_bytes(self) -> bytes:
+        """
+        Serializes the token arrays (but not the source) in native byte order.
+        """
+        parts = [TokenStream.header.pack(TokenStream.magic, TOKENIZER_VERSION, len(self))]
+        parts.extend(a.tobytes() for a in (self.kinds, self.starts, self.offsets, self.lengths))
+        return b''.join(parts)
+
+    @staticmethod
+    def from_bytes(source: str, data: bytes) -> 'TokenStream':
+        """
+        Inverse of to_bytes(). <source> must be the text that was tokenized.
+        """
+        magic, version, n = TokenStream.header.unpack_from(data)
+        assert magic == TokenStream.magic, magic
+        assert version == TOKENIZER_VERSION, version
+        stream = TokenStream(source)
+        pos = TokenStream.header.size
+        for a in (stream.kinds, stream.starts, stream.offsets, stream.lengths):
+            size = n * a.itemsize
+            a.frombytes(data[pos:pos + size])
+            pos += size
+        assert pos == len(data), (pos, len(data))
+        return stream
+
+
+class Diagnostic(NamedTuple):
+    """
+    A problem found by FastLatexTokenizer in recovery mode.
+    """
+    offset: int  # in the source
+    message: str
+
+
+class FastLatexTokenizer:
+    """
+    Produces exactly the same token stream as LatexTokenizer, but consumes
+    whole runs of text, whitespace and command letters with one regex match
+    each, instead of pushing and popping an Item per character.
+
+    LatexTokenizer remains the reference implementation; any divergence
+    between the two is a bug in this class.
+    """
+    # Text.handle() appends every char except these to its buffer
+    text_re = re.compile(r"""
+        (?P<Text>[^$.,?;:(){}`'\\\s]+)
+        |(?P<Space>\s+)
+        |(?P<Punct>[.,?;:])
+        |(?P<LParen>\()
+        |(?P<RParen>\))
+        |(?P<LGroup>\{)
+        |(?P<RGroup>\})
+        |(?P<LDQuote>``)
+        |(?P<LQuote>`)
+        |(?P<RDQuote>'')
+        |(?P<RQuote>')
+        |(?P<Command>\\[^\W\d_]*)
+        |(?P<Math>\$)
+        """, re.VERBOSE)
+
+    # tokenize_math_char() semantics, plus the Command item in math mode
+    math_re = re.compile(r"""
+        (?P<Space>\s+)
+        |(?P<Punct>[.,?;:])
+        |(?P<Symbol>[-+<>=])
+        |(?P<Char>[\[\]()^_{}'])
+        |(?P<Command>\\[^\W\d_]+)
+        |(?P<CmdChar>\\[{}|])
+        |(?P<CmdSpace>\\\ )
+        |(?P<BadCmd>\\)
+        |(?P<Math>\$)
+        |(?P<Other>.)
+        """, re.VERBOSE | re.DOTALL)
+
+    K = TokenStream.kind_of_name
+
+    math_char_kinds = {
+        '[': K['LBrack'],
+        ']': K['RBrack'],
+        '(': K['LParen'],
+        ')': K['RParen'],
+        '^': K['Super'],
+        '_': K['Sub'],
+        '{': K['LCurly'],
+        '}': K['RCurly'],
+        "'": K['RQuote'],
+    }
+
+    cmd_char_kinds = {
+        '{': K['LCurly'],
+        '}': K['RCurly'],
+        '|': K['VBar'],
+    }
+
+    def __init__(self, recover: bool=False):
+        """
+        By default, malformed input raises the same exception as it does in
+        LatexTokenizer. With <recover>, each problem is instead recorded in
+        self.diagnostics and tokenization resynchronizes:
+
+        - math left open at a blank line or at the end of the input is closed
+          there, with a zero-width EndInlineMath/EndDisplayMath token
+        - an invalid command in math (e.g. "\\]" or "\\$") is skipped
+        - "$$$" opens display math as "$$" would
+
+        Recovery is only supported for whole documents, not iter_tokens().
+        """
+        self.stream: Optional[TokenStream] = None
+        self.diagnostics: Optional[List[Diagnostic]] = [] if recover else None
+        self.reset()
+
+    def reset(self):
+        """
+        Returns to the state at the start of a document, so that one tokenizer
+        can be reused for many (see tokenize_many()).
+        """
+        self.mode: Mode = Mode.Text
+        self.at_start = True
+        # offset of the '$' that opened the current math, for diagnostics
+        self.math_start = 0
+        # DisplayMath closes on its second '$', not necessarily adjacent
+        self.close_count = 0
+        self.close_start = 0
+
+    @property
+    def toks(self) -> TokenStream:
+        return self.stream
+
+    @staticmethod
+    def alpha_len(source: str, i: int, j: int) -> int:
+        """
+        Returns the length of the str.isalpha() prefix of source[i:j].
+
+        [^\\W\\d_] admits a few numeric chars (e.g. superscript digits) that
+        str.isalpha() rejects, so regex matches of command names are trimmed
+        with this.
+        """
+        name = source[i:j]
+        if name.isalpha():
+            return j - i
+        for k, c in enumerate(name):
+            if not c.isalpha():
+                return k
+        return j - i
+
+    def tokenize(self, source: str):
+        self.stream = TokenStream(source)
+        self.scan(source, 0, final=True)
+
+    def tokenize_mapped(self, source: MappedSource, chunk_size: int=1 << 20):
+        """
+        Tokenizes a memory-mapped file, decoding only a chunk of it at a time,
+        into a TokenStream over <source> whose offsets are byte offsets. Raises
+        UnicodeDecodeError if the file is not in source.encoding.
+        """
+        out = TokenStream(source)
+        decoder = codecs.getincrementaldecoder(source.encoding)()
+        data = source.map
+        n = len(data)
+        text = ''
+        base = 0  # byte offset of text[0]
+        pos = 0
+        i = 0
+        while True:
+            chunk = data[pos:pos + chunk_size]
+            pos += len(chunk)
+            final = pos >= n
+            keep = i
+            if self.mode != Mode.Text and self.diagnostics is not None:
+                # an unterminated math diagnostic points at its opening '$'
+                keep = min(keep, self.math_start)
+            if self.mode == Mode.DisplayMath and self.close_count == 1:
+                keep = min(keep, self.close_start)
+                self.close_start -= keep
+            self.math_start -= keep
+            base += len(text[:keep].encode(source.encoding))
+            text = text[keep:] + decoder.decode(chunk, final)
+            i -= keep
+            num_diagnostics = len(self.diagnostics or ())
+            self.stream = TokenStream(text)
+            i = self.scan(text, i, final)
+
+            stream = self.stream
+            if source.encoding == 'latin-1' or text.isascii():
+                to_bytes = base.__add__  # one byte per char
+            else:
+                to_bytes = FastLatexTokenizer.utf8_offsets(text, base)
+            offsets = array('I', map(to_bytes, stream.offsets))
+            out.kinds.extend(stream.kinds)
+            out.starts.extend(array('I', map(to_bytes, stream.starts)))
+            out.offsets.extend(offsets)
+            if to_bytes == base.__add__:
+                out.lengths.extend(stream.lengths)
+            else:
+                ends = map(to_bytes, map(int.__add__, stream.offsets, stream.lengths))
+                out.lengths.extend(array('I', map(int.__sub__, ends, offsets)))
+            if self.diagnostics:
+                self.diagnostics[num_diagnostics:] = [d._replace(offset=to_bytes(d.offset))
+                        for d in self.diagnostics[num_diagnostics:]]
+            if final:
+                break
+        self.stream = out
+
+    @staticmethod
+    def utf8_offsets(text: str, base: int):
+        """
+        Returns a function mapping offsets in <text> to byte offsets in the
+        utf-8 encoded input, of which <text> starts at byte <base>.
+        """
+        return array('I', accumulate(map(len, map(str.encode, text)), initial=base)).__getitem__
+
+    def error(self, offset: int, exc: Exception):
+        """
+        Raises <exc>, or in recovery mode records it as a Diagnostic at
+        <offset> and returns, for the caller to resynchronize.
+        """
+        if self.diagnostics is None:
+            raise exc
+        self.diagnostics.append(Diagnostic(offset, str(exc)))
+
+    def close_math(self, offset: int):
+        """
+        Reports the current math as unterminated, and in recovery mode ends it
+        with a zero-width token at <offset>.
+        """
+        if self.mode == Mode.InlineMath:
+            self.error(self.math_start, Exception(f'Unterminated InlineMath({MathStart.Dollar})'))
+            kind = 'EndInlineMath'
+        else:
+            self.error(self.math_start, Exception('Unterminated DisplayMath'))
+            kind = 'EndDisplayMath'
+        self.stream.append(FastLatexTokenizer.K[kind], offset, offset, 0)
+        self.mode = Mode.Text
+
+    def iter_tokens(self, chunks: Iterable[str]) -> Iterator[LatexToken]:
+        """
+        Tokenizes source text arriving in chunks (e.g. from read_chunks()),
+        yielding each token as soon as no later input can change it.
+
+        Only the not-yet-final tail of the input is held in memory. Yielded
+        tokens have start/end, and self.diagnostics offsets, relative to the
+        beginning of the whole input.
+        """
+        chunks = iter(chunks)
+        source = ''
+        base = 0  # offset of source[0] in the whole input
+        i = 0
+        while True:
+            chunk = next(chunks, None)
+            final = chunk is None
+            keep = i
+            if self.mode != Mode.Text and self.diagnostics is not None:
+                # an unterminated math diagnostic points at its opening '$'
+                keep = min(keep, self.math_start)
+            if self.mode == Mode.DisplayMath and self.close_count == 1:
+                # EndDisplayMath's span will start at the first closing '$'
+                keep = min(keep, self.close_start)
+                self.close_start -= keep
+            self.math_start -= keep
+            source = source[keep:] + (chunk or '')
+            base += keep
+            i -= keep
+            num_diagnostics = len(self.diagnostics or ())
+            self.stream = TokenStream(source)
+            try:
+                i = self.scan(source, i, final)
+            finally:
+                if self.diagnostics:
+                    self.diagnostics[num_diagnostics:] = [d._replace(offset=d.offset + base)
+                            for d in self.diagnostics[num_diagnostics:]]
+                for k in range(len(self.stream)):
+                    tok = self.stream[k]
+                    tok.start += base
+                    tok.end += base
+                    yield tok
+            if final:
+                return
+
+    def scan(self, source: str, i: int, final: bool, end: Optional[int]=None) -> int:
+        """
+        Tokenizes source[i:] into self.stream, resuming from the current
+        mode. Returns the index at which scanning stopped.
+
+        If <final> is False, more input may follow source, so scanning stops
+        before any token that could still be extended or changed by it.
+        Otherwise, everything is consumed and unterminated math is an error.
+
+        If <end> is given, scanning stops at the first token boundary at or
+        past it instead.
+        """
+        n = len(source)
+        end = n if end is None else min(end, n)
+        if self.at_start:
+            if i == n and not final:
+                return i
+            self.at_start = False
+            m = FastLatexTokenizer.text_re.match(source, i)
+            if m is None or m.lastgroup != 'Text':
+                # LatexTokenizer starts with Items.Text(''), whose buf [''] is
+                # truthy, so it commits an empty Text unless text comes first
+                self.stream.append(FastLatexTokenizer.K['Text'], i, i, 0)
+        while i < end:
+            mode = self.mode
+            if mode == Mode.Text:
+                i = self.tokenize_text(source, i, final, end)
+            else:
+                i = self.tokenize_math(source, i, final, end)
+            if self.mode == mode:
+                break
+        if final and i == n and self.mode != Mode.Text:
+            self.close_math(n)
+        return i
+
+    def tokenize_text(self, source: str, i: int, final: bool, end: int) -> int:
+        """
+        Tokenizes text-mode source starting at index <i>. Returns the index
+        just past the opening math delimiter after switching mode, or where
+        scanning stopped.
+        """
+        K = FastLatexTokenizer.K
+        append = self.stream.append
+        match = FastLatexTokenizer.text_re.match
+        n = len(source)
+        while i < end:
+            m = match(source, i)
+            kind = m.lastgroup
+            j = m.end()
+            if j == n and not final:
+                # runs, quotes and commands may continue in the next chunk
+                return i
+            if kind == 'Text' or kind == 'Punct':
+                append(K[kind], i, i, j - i)
+            elif kind == 'Command':
+                j = i + 1 + FastLatexTokenizer.alpha_len(source, i + 1, j)
+                append(K['Command'], i, i, j - i)
+            elif kind == 'Math':
+                if j == n:
+                    self.error(i, Exception(f'Unterminated InlineMath({MathStart.Dollar})'))
+                    return j
+                self.math_start = i
+                if source[j] != '$':
+                    append(K['StartInlineMath'], i, j, 0)
+                    self.mode = Mode.InlineMath
+                    return j
+                j += 1
+                if j == n:
+                    if not final:
+                        return i
+                    self.error(i, Exception('Unterminated DisplayMath'))
+                    return j
+                if source[j] == '$':
+                    self.error(i, AssertionError('$$$'))
+                # DisplayMath(Pos.Begin) swallows the char after the opening $$
+                j += 1
+                append(K['StartDisplayMath'], i, j, 0)
+                self.mode = Mode.DisplayMath
+                self.close_count = 0
+                return j
+            else:
+                append(K[kind], i, j, 0)
+            i = j
+        return i
+
+    def tokenize_math(self, source: str, i: int, final: bool, end: int) -> int:
+        """
+        Tokenizes math-mode source starting at index <i>. Returns the index
+        just past the closing delimiter after switching mode, or where
+        scanning stopped.
+        """
+        K = FastLatexTokenizer.K
+        append = self.stream.append
+        match = FastLatexTokenizer.math_re.match
+        display = self.mode == Mode.DisplayMath
+        recover = self.diagnostics is not None
+        n = len(source)
+        while i < end:
+            m = match(source, i)
+            kind = m.lastgroup
+            j = m.end()
+            if kind == 'Space':
+                if recover and j == n and not final:
+                    return i  # may become a blank line
+                if recover and source.count('\n', i, j) >= 2:
+                    # a blank line ends a paragraph, which math cannot span
+                    self.close_math(i)
+                    return i
+            elif kind == 'Other':
+                if source[i].isnumeric():
+                    append(K['Number'], i, i, 1)
+                else:
+                    append(K['Text'], i, i, 1)
+            elif kind == 'Punct' or kind == 'Symbol':
+                append(K[kind], i, i, 1)
+            elif kind == 'Char':
+                append(FastLatexTokenizer.math_char_kinds[source[i]], i, j, 0)
+            elif kind == 'Command':
+                if j == n and not final:
+                    return i
+                j = i + 1 + FastLatexTokenizer.alpha_len(source, i + 1, j)
+                if j == i + 1:
+                    self.error(i, AssertionError(f'Unexpected command char {source[j]!r}'))
+                    j += 1
+                else:
+                    append(K['Command'], i, i + 1, j - i - 1)
+            elif kind == 'CmdChar':
+                append(FastLatexTokenizer.cmd_char_kinds[source[i+1]], i, j, 0)
+            elif kind == 'CmdSpace':
+                append(K['Command'], i, i + 1, 1)
+            elif kind == 'BadCmd':
+                if j == n and not final:
+                    return i
+                # Items.Command asserts on any other char, including '[' and
+                # ']', whose branches require a non-math item below it
+                if j < n:
+                    self.error(i, AssertionError(f'Unexpected command char {source[j]!r}'))
+                    j += 1
+            elif kind == 'Math':
+                if not display:
+                    append(K['EndInlineMath'], i, j, 0)
+                    self.mode = Mode.Text
+                    return j
+                self.close_count += 1
+                if self.close_count == 1:
+                    self.close_start = i
+                else:
+                    append(K['EndDisplayMath'], self.close_start, j, 0)
+                    self.mode = Mode.Text
+                    return j
+            i = j
+        return i
+
+
+class TokenBatch(Sequence):
+    """
+    The tokens of many documents, as returned by tokenize_many().
+
+    The TokenStream arrays of all documents are concatenated, and the tokens
+    of the d'th document are [doc_starts[d], doc_starts[d + 1]). Offsets are
+    relative to each document's own text.
+
+    Indexing returns the d'th document's TokenStream, or raises the exception
+    its tokenization raised.
+    """
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.kinds = array('B')
+        self.starts = array('I')
+        self.offsets = array('I')
+        self.lengths = array('I')
+        self.doc_starts = array('I', [0])
+        self.errors: Dict[int, Exception] = {}
+
+    def __len__(self) -> int:
+        return len(self.doc_starts) - 1
+
+    def num_tokens(self, d: int) -> int:
+        d = range(len(self))[d]
+        return self.doc_starts[d + 1] - self.doc_starts[d]
+
+    def __getitem__(self, d):
+        if isinstance(d, slice):
+            return [self[k] for k in range(*d.indices(len(self)))]
+        d = range(len(self))[d]  # negative indices, and IndexError past the end
+        if d in self.errors:
+            raise self.errors[d]
+        a, b = self.doc_starts[d], self.doc_starts[d + 1]
+        stream = TokenStream(self.texts[d])
+        stream.kinds = self.kinds[a:b]
+        stream.starts = self.starts[a:b]
+        stream.offsets = self.offsets[a:b]
+        stream.lengths = self.lengths[a:b]
+        return stream
+
+    def extend(self, other: 'TokenBatch', texts: List[str]):
+        """
+        Appends the documents of <other>, whose texts are <texts>.
+        """
+        base_doc = len(self)
+        base = len(self.kinds)
+        self.texts.extend(texts)
+        self.kinds.extend(other.kinds)
+        self.starts.extend(other.starts)
+        self.offsets.extend(other.offsets)
+        self.lengths.extend(other.lengths)
+        self.doc_starts.extend(array('I', map(base.__add__, other.doc_starts[1:])))
+        for d, e in other.errors.items():
+            self.errors[base_doc + d] = e
+
+
+# Total chars above which tokenize_many() fans out to worker processes
+PARALLEL_THRESHOLD = 4 << 20
+
+
+def tokenize_many(texts: Iterable[str], jobs: int=1,
+        parallel_threshold: int=PARALLEL_THRESHOLD) -> TokenBatch:
+    """
+    Tokenizes many documents with the Fast engine, reusing one tokenizer and
+    appending all tokens to one set of arrays. A document that fails to
+    tokenize contributes no tokens; its exception is kept in .errors.
+
+    If jobs > 1 and the texts total at least <parallel_threshold> chars,
+    contiguous chunks of them are tokenized in that many worker processes.
+    """
+    texts = list(texts)
+    if jobs > 1 and sum(map(len, texts)) >= parallel_threshold:
+        chunk_size = -(-len(texts) // (4 * jobs))
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        batch = TokenBatch([])
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for chunk, chunk_batch in zip(chunks, executor.map(_tokenize_chunk, chunks)):
+                batch.extend(chunk_batch, chunk)
+        return batch
+
+    batch = TokenBatch(texts)
+    tokenizer = FastLatexTokenizer()
+    stream = tokenizer.stream = TokenStream('')
+    stream.kinds = batch.kinds
+    stream.starts = batch.starts
+    stream.offsets = batch.offsets
+    stream.lengths = batch.lengths
+    for d, text in enumerate(texts):
+        tokenizer.reset()
+        stream.source = text
+        try:
+            tokenizer.scan(text, 0, final=True)
+        except Exception as e:
+            n = batch.doc_starts[-1]
+            for a in (batch.kinds, batch.starts, batch.offsets, batch.lengths):
+                del a[n:]
+            batch.errors[d] = e
+        batch.doc_starts.append(len(batch.kinds))
+    return batch
+
+
+def _tokenize_chunk(texts: List[str]) -> TokenBatch:
+    batch = tokenize_many(texts)
+    batch.texts = []  # the parent has them; don't pickle them back
+    return batch
+
+
+class RustLatexTokenizerOutput(ctypes.Structure):
+    """
+    struct LatexTokenizerOutput in src/latex_tokenizer/ffi.rs
+    """
+    _fields_ = [
+        ('kinds', ctypes.POINTER(ctypes.c_uint8)),
+        ('num_tokens', ctypes.c_size_t),
+        ('lengths', ctypes.POINTER(ctypes.c_uint32)),
+        ('num_lengths', ctypes.c_size_t),
+        ('text', ctypes.POINTER(ctypes.c_char)),
+        ('text_len', ctypes.c_size_t),
+        ('error', ctypes.POINTER(ctypes.c_char)),
+        ('error_len', ctypes.c_size_t),
+        ('owner', ctypes.c_void_p),
+    ]
+
+
+class RustLatexTokenizer:
+    """
+    Runs the Rust LatexTokenizer from src/latex_tokenizer, via the C ABI in
+    ffi.rs, and converts its output to LatexTokens. The shared library is
+    built with:
+
+        cd src/latex_tokenizer && cargo build --release --lib
+
+    Set $LATEX_TOKENIZER_LIB to load it from elsewhere.
+
+    The Rust tokenizer mirrors the state machine of LatexTokenizer, so it
+    produces the same tokens, and raises the same types of errors:
+    AssertionError on malformed input, and Exception on unterminated math.
+    """
+    library_path = os.environ.get('LATEX_TOKENIZER_LIB', os.path.normpath(os.path.join(
+        os.path.dirname(__file__), '..', '..', 'latex_tokenizer', 'target', 'release',
+        {'darwin': 'liblatex_tokenizer.dylib', 'win32': 'latex_tokenizer.dll'}.get(
+            sys.platform, 'liblatex_tokenizer.so'))))
+
+    _lib: Optional[ctypes.CDLL] = None
+    _load_error: Optional[OSError] = None
+
+    @staticmethod
+    def load() -> Optional[ctypes.CDLL]:
+        """
+        Returns the shared library, or None if it is not built. Only tries to
+        load it once.
+        """
+        cls = RustLatexTokenizer
+        if cls._lib is None and cls._load_error is None:
+            try:
+                lib = ctypes.CDLL(cls.library_path)
+            except OSError as e:
+                cls._load_error = e
+                return None
+            lib.latex_tokenizer_tokenize.argtypes = [
+                ctypes.c_char_p, ctypes.c_size_t, ctypes.POINTER(RustLatexTokenizerOutput)]
+            lib.latex_tokenizer_tokenize.restype = ctypes.c_bool
+            lib.latex_tokenizer_free.argtypes = [ctypes.POINTER(RustLatexTokenizerOutput)]
+            lib.latex_tokenizer_free.restype = None
+            cls._lib = lib
+        return cls._lib
+
+    @staticmethod
+    def available() -> bool:
+        return RustLatexTokenizer.load() is not None
+
+    def __init__(self):
+        self.toks: List[LatexToken] = []
+
+    def tokenize(self, source: str):
+        lib = RustLatexTokenizer.load()
+        if lib is None:
+            raise RuntimeError(f'Rust tokenizer not available: {RustLatexTokenizer._load_error}')
+        data = source.encode('utf-8')
+        out = RustLatexTokenizerOutput()
+        if not lib.latex_tokenizer_tokenize(data, len(data), ctypes.byref(out)):
+            raise ValueError('source is not valid utf-8')
+        try:
+            if out.error:
+                error = ctypes.string_at(out.error, out.error_len).decode('utf-8')
+                raise (Exception if error.startswith('Unterminated') else AssertionError)(error)
+            kinds = ctypes.string_at(out.kinds, out.num_tokens)
+            lengths = array('I', ctypes.string_at(out.lengths, 4 * out.num_lengths))
+            text = ctypes.string_at(out.text, out.text_len).decode('utf-8')
+        finally:
+            lib.latex_tokenizer_free(ctypes.byref(out))
+
+        kind_classes = TokenStream.kind_classes
+        has_text = TokenStream.has_text
+        toks = self.toks
+        pos = 0
+        k = 0
+        for kind in kinds:
+            cls = kind_classes[kind]
+            if has_text[kind]:
+                end = pos + lengths[k]
+                toks.append(cls(text[pos:end]))
+                pos = end
+                k += 1
+            else:
+                toks.append(cls())
+
+
+def read_chunks(f: IO[str], chunk_size: int=1 << 16) -> Iterator[str]:
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class Engine(Enum):
+    Reference = auto()  # LatexTokenizer
+    Fast = auto()  # FastLatexTokenizer
+    Rust = auto()  # RustLatexTokenizer if it is built, else Fast
+
+
 class LatexDocument:
-    def __init__(self, text: str):
+    def __init__(self, text: str, engine: Engine=Engine.Fast, recover: bool=False):
+        """
+        With the Fast engine, toks is a TokenStream, which materializes
+        LatexToken's lazily; it is also available as stream, whose spans and
+        payloads index directly into self.text. With the Reference engine,
+        toks is a plain list and stream is None; likewise with the Rust engine,
+        which falls back to Fast if the Rust library is not built.
+
+        With <recover> (Fast engine only), malformed input does not raise;
+        see FastLatexTokenizer. The problems found are in self.diagnostics.
+        """
+        assert engine == Engine.Fast or not recover, 'recover requires the Fast engine'
         self.text = text
-        tokenizer = LatexTokenizer()
+        self.stream: Optional[TokenStream] = None
+        self.recover = recover
+        self.diagnostics: List[Diagnostic] = []
+        if engine == Engine.Rust and not RustLatexTokenizer.available():
+            engine = Engine.Fast
+        if engine == Engine.Reference:
+            tokenizer = LatexTokenizer()
+        elif engine == Engine.Rust:
+            tokenizer = RustLatexTokenizer()
+        else:
+            tokenizer = FastLatexTokenizer(recover)
         tokenizer.tokenize(text)
-        self.toks = tokenizer.toks
+        self.toks: Sequence = tokenizer.toks
+        if engine == Engine.Fast:
+            self.stream = tokenizer.stream
+            self.diagnostics = tokenizer.diagnostics or []
+
+    def edit(self, start: int, end: int, new_text: str) -> Tuple[int, int, int]:
+        """
+        Replaces self.text[start:end] with <new_text>, re-tokenizing only as
+        much as the edit can affect.
+
+        Tokenization resumes from the last text-mode token that starts before
+        <start> (tokens before it never look further ahead than its first
+        char), and stops once it reaches a text-mode token boundary past the
+        edit that the old stream also had. The old tokens after that point are
+        reused, shifted by the change in length.
+
+        Returns (first, old_stop, new_stop): tokens [first, old_stop) of the
+        old stream were replaced by tokens [first, new_stop) of the new one.
+        If the edited text fails to tokenize, raises and leaves the document
+        unchanged. Documents in recovery mode are re-tokenized in full, since
+        recovery can change how everything after a problem is tokenized.
+        """
+        assert self.stream is not None, 'edit() requires the Fast engine'
+        assert isinstance(self.text, str), 'edit() requires a str document'
+        old = self.stream
+        text = self.text[:start] + new_text + self.text[end:]
+        delta = len(new_text) - (end - start)
+        kinds = old.kinds.tobytes()
+
+        first = bisect_left(old.starts, start) - 1
+        if self.recover:
+            first = 0
+        elif first >= 1:
+            first = old.text_mode_start(first, kinds)
+        if first < 1:
+            # the leading empty Text depends on the first char; start over
+            doc = LatexDocument(text, recover=self.recover)
+            self.text, self.stream, self.toks = text, doc.stream, doc.toks
+            self.diagnostics = doc.diagnostics
+            return 0, len(old), len(doc.stream)
+
+        tokenizer = FastLatexTokenizer()
+        tokenizer.at_start = False
+        tokenizer.stream = stream = TokenStream(text)
+        stream.kinds = old.kinds[:first]
+        stream.starts = old.starts[:first]
+        stream.offsets = old.offsets[:first]
+        stream.lengths = old.lengths[:first]
+
+        i = old.starts[first]
+        limit = start + len(new_text)
+        window = 64
+        scan_end = max(limit, i + window)
+        while True:
+            i = tokenizer.scan(text, i, final=True, end=scan_end)
+            if i == len(text):
+                old_stop = len(old)
+                break
+            if tokenizer.mode == Mode.Text and i >= limit:
+                k = bisect_left(old.starts, i - delta)
+                if (k < len(old) and old.starts[k] == i - delta and
+                        old.text_mode_start(k, kinds) == k):
+                    old_stop = k
+                    break
+            window *= 2
+            scan_end = i + window
+
+        new_stop = len(stream)
+        stream.kinds.extend(old.kinds[old_stop:])
+        stream.lengths.extend(old.lengths[old_stop:])
+        for name in ('starts', 'offsets'):
+            tail = getattr(old, name)[old_stop:]
+            if delta:
+                tail = array('I', map(delta.__add__, tail))
+            getattr(stream, name).extend(tail)
 
+        self.text = text
+        self.stream = self.toks = stream
+        return first, old_stop, new_stop
 
-if __name__ == '__main__':
-    filename = os.path.expanduser(sys.argv[1])
+    @staticmethod
+    def from_stream(stream: TokenStream) -> 'LatexDocument':
+        """
+        Wraps an already-tokenized stream, e.g. one loaded from a TokenCache.
+        """
+        doc = LatexDocument.__new__(LatexDocument)
+        doc.text = stream.source
+        doc.stream = stream
+        doc.toks = stream
+        doc.recover = False
+        doc.diagnostics = []
+        return doc
+
+    @staticmethod
+    def from_file(path: str, recover: bool=False) -> 'LatexDocument':
+        """
+        Tokenizes the file at <path> without reading it into a str: the file
+        is memory-mapped, and text is a MappedSource over the map, into which
+        the stream's offsets are byte offsets. Payloads are decoded only when
+        tokens are materialized.
+
+        Like corpus.decode(), falls back to latin-1 if the file is not utf-8.
+        Such documents do not support edit().
+        """
+        source = MappedSource(path)
+        tokenizer = FastLatexTokenizer(recover)
+        try:
+            tokenizer.tokenize_mapped(source)
+        except UnicodeDecodeError:
+            source.encoding = 'latin-1'
+            tokenizer = FastLatexTokenizer(recover)
+            tokenizer.tokenize_mapped(source)
+        doc = LatexDocument.from_stream(tokenizer.stream)
+        doc.recover = recover
+        doc.diagnostics = tokenizer.diagnostics or []
+        return doc
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prints the tokens of a LaTeX file.')
+    parser.add_argument('filename')
+    parser.add_argument('--trace', metavar='FILE',
+            help='tokenize with the Reference engine, writing a JSON-lines trace of '
+            'its state machine to FILE')
+    parser.add_argument('--mmap', action='store_true',
+            help='memory-map the file instead of reading it')
+    args = parser.parse_args()
+    if args.mmap and args.trace:
+        parser.error('--mmap and --trace are exclusive')
+
+    filename = os.path.expanduser(args.filename)
+    if args.mmap:
+        for tok in LatexDocument.from_file(filename).toks:
+            print(tok)
+        return
     with open(filename) as f:
-        text = f.read()
-    doc = LatexDocument(text)
-    print('\n'.join(map(str, doc.toks)))
+        if args.trace is None:
+            for tok in FastLatexTokenizer().iter_tokens(read_chunks(f)):
+                print(tok)
+            return
+        with open(args.trace, 'w') as trace_file:
+            tokenizer = TracingLatexTokenizer(Tracer(trace_file))
+            for tok in tokenizer.iter_tokens(read_chunks(f)):
+                print(tok)
+
+
+if __name__ == '__main__':
+    main()
 
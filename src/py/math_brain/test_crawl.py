@@ -0,0 +1,108 @@
+"""
+Tests of Crawl against a local stand-in for wikipedia.
+
+Run with: python -m unittest math_brain.test_crawl (from src/py), or pytest.
+"""
+import json
+import os
+import shutil
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import tempfile
+import unittest
+
+from math_brain.crawl import SITES, ArticleStore, Crawl
+from util.test_web_cache import Handler, LocalServerTest
+
+
+def wiki_page(title: str, links: list) -> str:
+    anchors = ' '.join(f'<a href="/wiki/{link}">{link}</a>' for link in links)
+    return ('<html><body><div id="content"><h1>%s</h1><div id="bodyContent">'
+            '<div id="mw-content-text"><div class="mw-parser-output">'
+            '<p>About %s. See %s</p>'
+            '</div></div></div></div></body></html>') % (title, title, anchors)
+
+
+class WikiHandler(Handler):
+    """
+    /wiki/t<n> is an article linking to t<2n+1> and t<2n+2>, so the articles
+    form a binary tree under t0. /wiki/flaky answers 503 to its first request,
+    /wiki/missing is a 404.
+    """
+    def do_GET(self):
+        if not self.path.startswith('/wiki/'):
+            return super().do_GET()
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            first = server.requests.count(self.path) == 1
+        topic = self.path[len('/wiki/'):]
+        if topic == 'missing' or (topic == 'flaky' and first):
+            self.send_error(404 if topic == 'missing' else 503)
+            return
+        if topic == 'flaky':
+            body = wiki_page('Flaky', [])
+        else:
+            n = int(topic[1:])
+            body = wiki_page(f'T{n}', [f'T{2 * n + 1}', f'T{2 * n + 2}'])
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class CrawlTest(LocalServerTest):
+    handler_class = WikiHandler
+
+    def setUp(self):
+        super().setUp()
+        self.out_dir = tempfile.mkdtemp()
+        # parse_page() looks the site up by name, in the worker processes
+        self.site = SITES['wikipedia']._replace(
+                article_url=lambda topic: self.url(f'/wiki/{topic}'))
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.out_dir)
+
+    def crawl(self, topics, depth: int=0) -> Crawl:
+        crawl = Crawl(self.site, self.web_cache(), ArticleStore(self.out_dir), depth, jobs=2,
+                batch_size=2, backoff=0.01)
+        crawl.run(topics)
+        return crawl
+
+    def test_retry_transient_error(self):
+        crawl = self.crawl(['Flaky'])
+        self.assertEqual((crawl.num_parsed, crawl.failed), (1, []))
+        self.assertEqual(self.server.requests, ['/wiki/flaky'] * 2)
+        record = ArticleStore(self.out_dir).read('wikipedia', 'Flaky')
+        self.assertEqual(record['article']['title'], 'Flaky')
+
+    def test_failure_logged(self):
+        crawl = self.crawl(['Missing'])
+        self.assertEqual((crawl.num_parsed, crawl.failed), (0, ['Missing']))
+        self.assertEqual(self.server.requests, ['/wiki/missing'])  # a 404 is not retried
+        entry, = ArticleStore(self.out_dir).logged().values()
+        self.assertEqual(entry['topic'], 'Missing')
+        self.assertTrue(entry['error'].startswith('HTTPError'), entry['error'])
+
+    def test_depth_limit(self):
+        crawl = self.crawl(['T0'], depth=1)
+        self.assertEqual(crawl.num_parsed, 3)
+        self.assertEqual(sorted(self.server.requests), ['/wiki/t0', '/wiki/t1', '/wiki/t2'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.out_dir, 'wikipedia'))),
+                ['T0.json', 'T1.json', 'T2.json'])
+
+    def test_resume_with_larger_depth(self):
+        self.crawl(['T0'], depth=1)
+        del self.server.requests[:]
+        crawl = self.crawl(['T0'], depth=2)
+        self.assertEqual((crawl.num_skipped, crawl.num_parsed), (3, 4))
+        self.assertEqual(sorted(self.server.requests), [f'/wiki/t{n}' for n in range(3, 7)])
+        with open(os.path.join(self.out_dir, 'crawl.jsonl')) as f:
+            self.assertEqual(len([json.loads(line) for line in f]), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
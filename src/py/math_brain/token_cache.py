@@ -0,0 +1,58 @@
+"""
+Module to cache tokenized documents on disk.
+
+Entries are keyed on a hash of the document text and TOKENIZER_VERSION, so an
+edited file or a tokenizer change simply misses the cache. Tokenization errors
+are cached too, so a known-bad file does not get re-tokenized on every run.
+"""
+import hashlib
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from typing import Optional
+
+from math_brain.latex_tokenizer import LatexDocument, TokenStream, TOKENIZER_VERSION
+from util.disk_cache import DiskCache
+
+DEFAULT_TOKEN_CACHE_DIRECTORY = os.path.expanduser(f'~/mathbrain/token_cache')
+DEFAULT_MAX_BYTES = 256 << 20
+
+
+class TokenCache(DiskCache):
+    # Prefix of entries that record a tokenization error rather than a TokenStream
+    error_magic = b'LERR'
+
+    def __init__(self,
+            cache_dir: str=DEFAULT_TOKEN_CACHE_DIRECTORY,
+            max_bytes: int=DEFAULT_MAX_BYTES):
+        """
+        When the cache grows past max_bytes, the least recently used entries
+        are evicted.
+        """
+        super().__init__(cache_dir, max_bytes)
+
+    @staticmethod
+    def key(text: str) -> str:
+        h = hashlib.sha256(f'{TOKENIZER_VERSION}\0'.encode())
+        h.update(text.encode('utf-8', 'surrogatepass'))
+        return h.hexdigest()
+
+    def get(self, text: str) -> Optional[TokenStream]:
+        """
+        Returns the cached TokenStream for <text>, or None on a miss. Raises
+        a cached tokenization error as a CachedError.
+        """
+        data = self.get_bytes(TokenCache.key(text))
+        return None if data is None else TokenStream.from_bytes(text, data)
+
+    def put(self, text: str, data: bytes):
+        self.put_bytes(TokenCache.key(text), data)
+
+    def document(self, text: str) -> LatexDocument:
+        """
+        Returns a LatexDocument for <text>, tokenizing it only on a cache miss.
+        A tokenization error is raised as a CachedError (see DiskCache.load()).
+        """
+        return self.load(TokenCache.key(text), lambda: LatexDocument(text),
+                lambda doc: doc.stream.to_bytes(),
+                lambda data: LatexDocument.from_stream(TokenStream.from_bytes(text, data)))
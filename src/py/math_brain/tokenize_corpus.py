@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Tokenizes every problem file in the corpus, in parallel, and reports which
+files fail to tokenize.
+
+Python counterpart of src/latex_tokenizer/tokenize_corpus.rs, except that the
+corpus is discovered on disk (see corpus.py) rather than hard-coded.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from math_brain.corpus import REPO_ROOT, CorpusEntry, Header, find_corpus_files
+from math_brain.latex_tokenizer import Engine, LatexDocument, RustLatexTokenizer
+from math_brain.token_cache import TokenCache
+
+
+class FileResult(NamedTuple):
+    path: str
+    num_chars: int
+    num_toks: int
+    seconds: float
+    error: Optional[str]
+    diagnostics: List[str]
+
+
+# TokenCache's by directory, one per worker process, so that each computes the
+# size of its cache once, rather than once per file
+_token_caches: Dict[str, TokenCache] = {}
+
+
+def token_cache(cache_dir: str) -> TokenCache:
+    cache = _token_caches.get(cache_dir)
+    if cache is None:
+        cache = _token_caches[cache_dir] = TokenCache(cache_dir)
+    return cache
+
+
+def tokenize_file(path: str, root: str, engine: Engine, compare: Optional[Engine],
+        cache_dir: Optional[str], recover: bool) -> FileResult:
+    # like AnnotatedLatexDocument::open, skip the %% header
+    header = Header.read(os.path.join(root, path))
+    text = CorpusEntry(root, path, header).body
+    start = time.perf_counter()
+    num_toks = 0
+    error = None
+    diagnostics = []
+    try:
+        if cache_dir is None:
+            doc = LatexDocument(text, engine, recover)
+        else:
+            doc = token_cache(cache_dir).document(text)
+        num_toks = len(doc.toks)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    seconds = time.perf_counter() - start
+
+    if recover and error is None and doc.diagnostics:
+        with open(os.path.join(root, path), 'rb') as f:
+            header_lines = f.read(header.body_offset).count(b'\n')
+        for diagnostic in doc.diagnostics:
+            line, col = doc.stream.line_col(diagnostic.offset)
+            diagnostics.append(f'{path}:{header_lines + line}:{col}: {diagnostic.message}')
+        error = f'{len(diagnostics)} problems'
+
+    if compare is not None:
+        error = compare_engines(text, engine, compare) or error
+    return FileResult(path, len(text), num_toks, seconds, error, diagnostics)
+
+
+def tokens_or_error(text: str, engine: Engine):
+    try:
+        return [str(tok) for tok in LatexDocument(text, engine).toks]
+    except Exception as e:
+        return type(e).__name__
+
+
+def compare_engines(text: str, engine: Engine, other: Engine) -> Optional[str]:
+    """
+    Returns a description of the first divergence between <engine> and
+    <other> on <text>, or None if they agree.
+    """
+    a_toks = tokens_or_error(text, engine)
+    b_toks = tokens_or_error(text, other)
+    a_name = engine.name.lower()
+    b_name = other.name.lower()
+    if a_toks == b_toks:
+        return None
+    if isinstance(a_toks, str) or isinstance(b_toks, str):
+        return (f'engine mismatch: {a_name}={summarize(a_toks)} '
+                f'{b_name}={summarize(b_toks)}')
+    for i, (a, b) in enumerate(zip(a_toks, b_toks)):
+        if a != b:
+            return f'engine mismatch at token {i}: {a_name}={a} {b_name}={b}'
+    return (f'engine mismatch: {a_name} has {len(a_toks)} tokens, '
+            f'{b_name} has {len(b_toks)}')
+
+
+def summarize(toks) -> str:
+    if isinstance(toks, str):
+        return toks
+    return f'<{len(toks)} tokens>'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('paths', nargs='*',
+            help='files to tokenize, relative to --root (default: the whole corpus)')
+    parser.add_argument('--root', default=REPO_ROOT, help='corpus root (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+            help='number of worker processes (default: %(default)s)')
+    parser.add_argument('--engine', choices=[e.name for e in Engine], default=Engine.Fast.name)
+    parser.add_argument('--compare', nargs='?', const=Engine.Reference.name,
+            choices=[e.name for e in Engine], metavar='ENGINE',
+            help='also fail files on which --engine and ENGINE (default: Reference) '
+            'disagree')
+    parser.add_argument('--cache', metavar='DIR',
+            help='reuse tokens cached in DIR for unchanged files (Fast engine only)')
+    parser.add_argument('--recover', action='store_true',
+            help='report every problem in each file, rather than only the first '
+            '(Fast engine only)')
+    args = parser.parse_args()
+    if args.cache and args.engine != Engine.Fast.name:
+        parser.error('--cache requires --engine Fast')
+    if args.recover and (args.engine != Engine.Fast.name or args.cache):
+        parser.error('--recover requires --engine Fast, without --cache')
+    if Engine.Rust.name in (args.engine, args.compare) and not RustLatexTokenizer.available():
+        parser.error(f'Rust tokenizer not built: {RustLatexTokenizer.library_path}')
+
+    paths = args.paths or find_corpus_files(args.root)
+    engine = Engine[args.engine]
+    compare = None if args.compare is None else Engine[args.compare]
+    n = len(paths)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(tokenize_file, paths, [args.root] * n, [engine] * n,
+                [compare] * n, [args.cache] * n, [args.recover] * n,
+                chunksize=max(1, n // (4 * args.jobs)))
+        errs = []
+        for result in results:
+            status = 'FAIL' if result.error else 'ok'
+            print(f'{status:4} {result.path}: {result.num_chars} chars, {result.num_toks} tokens, '
+                    f'{1000 * result.seconds:.1f}ms')
+            if result.error:
+                print(f'     {result.error}')
+                errs.append(result.path)
+            for diagnostic in result.diagnostics:
+                print(f'     {diagnostic}')
+    elapsed = time.perf_counter() - start
+
+    print(f'{n} files in {elapsed:.2f}s')
+    if errs:
+        print(f'errors: n={len(errs)} {errs}')
+        sys.exit(1)
+    print('all passed')
+
+
+if __name__ == '__main__':
+    main()
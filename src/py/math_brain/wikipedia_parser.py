@@ -5,12 +5,24 @@ Does a best-effort parse of a wikipedia article.
 import os
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
+import urllib.parse
 import xml.etree.ElementTree as ET
 
+from math_brain.article_cache import ArticleCache
+from math_brain.article_parser import ArticleParser
 from util.str_util import ellipsize, get_html_header_level
 from util.web_cache import WebCache
-from util.xml_util import elem_to_str, get_inside_text, get_node
+from util.xml_util import (NodeIndex, cached_inside_text, elem_to_str, get_node, has_inside_text,
+        matches, parse_path, str_to_elem)
+
+
+# From <html> down to the meat of the article
+CONTENT_PATH = parse_path('body/div#content/div#bodyContent/div#mw-content-text/div.mw-parser-output')
+# The article title is the <h1> child of CONTENT_PATH[TITLE_DEPTH - 1]
+TITLE_DEPTH = 2
+# hrefs of links to other articles start with this
+ARTICLE_LINK_PREFIX = '/wiki/'
 
 
 def latexify(tree: ET.Element):
@@ -26,22 +38,49 @@ def latexify(tree: ET.Element):
     The resultant html seems to display as an <img>, with the source latex
     available in the alt= tag of the img element.
 
-    This function accepts an ET.Element, and recursively searches the tree for
-    elements that came from <math> source. Such elements are rewritten in
-    latex format, and wrapped with artificial <latex>...</latex> tags.
+    This function accepts an ET.Element, and searches the tree for elements
+    that came from <math> source. Such elements are rewritten in latex format,
+    and wrapped with artificial <latex>...</latex> tags.
+
+    The search is by tree.iter('span'), which walks the tree in C, rather than
+    by recursing in python over every element.
     """
-    if tree.tag == 'span' and tree.attrib.get('class', '').startswith('mwe-math-'):
-        img = get_node(tree, 'img')
+    # in document order, so each math span comes before any nested inside it,
+    # which are rewritten away with it
+    spans = [span for span in tree.iter('span')
+            if span.attrib.get('class', '').startswith('mwe-math-')]
+    nested = set()
+    for span in spans:
+        if span in nested:
+            continue
+        nested.update(span.iter('span'))
+        img = get_node(span, 'img')
         alt = img.attrib['alt']
-        elems = list(tree)
-        for elem in elems:
-            tree.remove(elem)
-        assert len(tree) == 0, elem_to_str(tree)
-        latex = ET.SubElement(tree, 'latex')
+        del span[:]
+        latex = ET.SubElement(span, 'latex')
         latex.text = alt
-        return
-    for elem in tree:
-        latexify(elem)
+
+
+def article_url(topic: str) -> str:
+    """
+    'Pythagorean_theorem' -> 'https://en.wikipedia.org/wiki/Pythagorean_theorem'
+    """
+    return f'https://en.wikipedia.org/wiki/{urllib.parse.quote(topic)}'
+
+
+def link_topic(href: str) -> Optional[str]:
+    """
+    '/wiki/Pythagorean_theorem#Proofs' -> 'Pythagorean_theorem'
+
+    Returns None if href is not a link to an article, e.g. if it links to a
+    File: or Help: page.
+    """
+    if not href.startswith(ARTICLE_LINK_PREFIX):
+        return None
+    topic = urllib.parse.unquote(href[len(ARTICLE_LINK_PREFIX):].partition('#')[0])
+    if not topic or ':' in topic:
+        return None
+    return topic
 
 
 def is_irrelevant(elem: ET.Element) -> bool:
@@ -49,7 +88,7 @@ def is_irrelevant(elem: ET.Element) -> bool:
         return True
     if elem.tag == 'div' and elem.attrib.get('style', '').find('display:none') != -1:
         return True
-    if elem.tag == 'div' and not get_inside_text(elem):
+    if elem.tag == 'div' and not has_inside_text(elem):
         return True
     if elem.tag == 'div' and elem.attrib.get('role', '') == 'note':
         return True
@@ -80,44 +119,76 @@ class WikiTree:
     ET.Elements devoid of relevant content are stripped out.
     """
     def __init__(self, header: ET.Element, body: List[ET.Element]):
+        """
+        Builds the whole tree in one pass over body, so that each element's
+        relevance and header level, and each section title, is computed once.
+
+        A section's branches are its sub-headers of the lowest level found in
+        it, e.g. <h4>'s directly under an <h2> with no <h3>'s; any deeper
+        headers before the first such one are left in its intro.
+        """
+        self._init_header(header)
+        nodes = [elem for elem in body if not is_irrelevant(elem)]
+        levels = [get_html_header_level(node.tag) for node in nodes]
+
+        # The lowest header level in the section of each header (None for
+        # nodes[-1], i.e. self), where a section runs up to the next header of
+        # its level or lower. Headers open sections within the section on top
+        # of the stack.
+        lowest: Dict[int, Optional[int]] = {-1: None}
+        stack = [(-1, self._level)]
+        for i, level in enumerate(levels):
+            if level is None:
+                continue
+            assert level > self._level, elem_to_str(nodes[i])
+            while stack[-1][1] >= level:
+                stack.pop()
+            outer = stack[-1][0]
+            if lowest[outer] is None or level < lowest[outer]:
+                lowest[outer] = level
+            lowest[i] = None
+            stack.append((i, level))
+
+        # (tree, its lowest header level), for the trees whose sections are open
+        trees: List[Tuple[WikiTree, Optional[int]]] = [(self, lowest[-1])]
+        for i, node in enumerate(nodes):
+            level = levels[i]
+            if level is not None:
+                while trees[-1][0].level >= level:
+                    trees.pop()
+            tree, branch_level = trees[-1]
+            if level is None or level != branch_level:
+                tree._intro.append(node)
+                continue
+            branch = WikiTree._branch(node)
+            if branch.title not in ('See also', 'References', 'Further reading', 'External links'):
+                # maybe these could be useful but leaving them out looks prettier for now
+                tree._branches.append(branch)
+            trees.append((branch, lowest[i]))
+
+    def _init_header(self, header: ET.Element):
         header_level = get_html_header_level(header.tag)
         assert header_level is not None
         if header_level == 1:
             # This is the top-level header, the name of the article
-            title = get_inside_text(header)
+            title = cached_inside_text(header)
         else:
             span = get_node(header, 'span', {'class': 'mw-headline'})
-            title = get_inside_text(span)
-
-        branches = []
-
-        nodes = [elem for elem in body if not is_irrelevant(elem)]
-        n = len(nodes)
-        sub_lvls = [get_html_header_level(node.tag) for node in nodes]
-        sub_lvls = [lvl for lvl in sub_lvls if lvl is not None]
-        intro_bound = n
-        if sub_lvls:
-            next_lvl = min(sub_lvls)
-            assert next_lvl > header_level
-            sub_indices = [i for (i, node) in enumerate(nodes) if get_html_header_level(node.tag) == next_lvl]
-            intro_bound = sub_indices[0]
-            num_sub_indices = len(sub_indices)
-            sub_indices.append(len(nodes))  # to make loop cleaner
-            for h in range(num_sub_indices):
-                sub_index = sub_indices[h]
-                next_sub_index = sub_indices[h+1]
-                tree = WikiTree(nodes[sub_index], nodes[sub_index+1:next_sub_index])
-                if tree.title in ('See also', 'References', 'Further reading', 'External links'):
-                    # maybe these could be useful but leaving it out looks prettier for now
-                    continue
-                branches.append(tree)
-
-        intro = nodes[:intro_bound]
+            title = cached_inside_text(span)
 
         self._level = header_level
         self._title = title
-        self._intro = intro
-        self._branches = branches
+        self._intro: List[ET.Element] = []
+        self._branches: List[WikiTree] = []
+
+    @staticmethod
+    def _branch(header: ET.Element) -> 'WikiTree':
+        """
+        An empty WikiTree for header, to be filled in by __init__().
+        """
+        tree = WikiTree.__new__(WikiTree)
+        tree._init_header(header)
+        return tree
 
     @property
     def level(self) -> int:
@@ -135,6 +206,41 @@ class WikiTree:
     def branches(self) -> List['WikiTree']:
         return self._branches
 
+    def links(self) -> List[str]:
+        """
+        The topics of the articles linked to from the intros of this tree and
+        its branches (see link_topic()), in order, without repeats.
+        """
+        topics = []
+        for elem in self.intro:
+            for a in elem.iter('a'):
+                topic = link_topic(a.attrib.get('href', ''))
+                if topic is not None:
+                    topics.append(topic)
+        for branch in self.branches:
+            topics.extend(branch.links())
+        return list(dict.fromkeys(topics))
+
+    def to_json(self) -> dict:
+        return {
+            'title': self.title,
+            'level': self.level,
+            'intro': [elem_to_str(elem) for elem in self.intro],
+            'branches': [branch.to_json() for branch in self.branches],
+        }
+
+    @staticmethod
+    def from_json(d: dict) -> 'WikiTree':
+        """
+        The inverse of to_json().
+        """
+        tree = WikiTree.__new__(WikiTree)
+        tree._level = d['level']
+        tree._title = d['title']
+        tree._intro = [str_to_elem(text) for text in d['intro']]
+        tree._branches = [WikiTree.from_json(branch) for branch in d['branches']]
+        return tree
+
     def dump(self, column_width: Optional[int]=None):
         indent = '*' * (self.level - 1)
         str_len = None if column_width is None else (column_width - len(indent))
@@ -149,6 +255,98 @@ class WikiTree:
             branch.dump(column_width)
 
 
+class ContentPruner:
+    """
+    Picks the <h1> title and the children of div.mw-parser-output out of a
+    partially parsed article, and drops everything else. See stream_content().
+
+    An element of a partial tree is complete if it is not the last child of
+    its parent, or if its parent is complete, so only the complete children
+    of the elements along CONTENT_PATH need looking at.
+    """
+    def __init__(self, root: ET.Element):
+        """
+        root is an element holding the document element as its only child.
+        """
+        self._root = root
+        # the document element, then the elements matching CONTENT_PATH found so far
+        self._path: List[ET.Element] = []
+        self.h1: Optional[ET.Element] = None
+        self.nodes: List[ET.Element] = []
+
+    def prune(self, final: bool):
+        """
+        final: whether the document has been parsed to the end.
+        """
+        if not self._path:
+            if len(self._root) == 0:
+                return
+            self._path.append(self._root[0])
+        complete = final  # whether self._path[k] is complete
+        k = 0
+        while k < len(self._path):
+            parent = self._path[k]
+            children = list(parent)
+            num_complete = len(children) if complete else len(children) - 1
+            keep = []
+            for i, child in enumerate(children):
+                if k + 1 < len(self._path) and child is self._path[k + 1]:
+                    keep.append(child)
+                elif k < len(CONTENT_PATH) and matches(child, *CONTENT_PATH[k]):
+                    assert len(self._path) == k + 1, (child.tag, child.attrib)
+                    self._path.append(child)
+                    keep.append(child)
+                elif i >= num_complete:
+                    keep.append(child)
+                elif k == len(CONTENT_PATH):
+                    latexify(child)
+                    if not is_irrelevant(child):
+                        self.nodes.append(child)
+                elif k == TITLE_DEPTH and child.tag == 'h1':
+                    assert self.h1 is None, elem_to_str(child)
+                    latexify(child)
+                    self.h1 = child
+            if len(keep) < len(children):
+                parent[:] = keep
+            if k + 1 < len(self._path):
+                complete = complete or children[-1] is not self._path[k + 1]
+            k += 1
+
+    def close(self):
+        """
+        Called once the document has been parsed to the end.
+        """
+        self.prune(final=True)
+        assert len(self._path) == len(CONTENT_PATH) + 1, [elem.tag for elem in self._path]
+        assert self.h1 is not None
+
+
+
+def stream_content(text: str, chunk_size: int=1<<16) -> Tuple[ET.Element, List[ET.Element]]:
+    """
+    Parses the html of an article incrementally, returning the <h1> title and
+    the relevant children of div.mw-parser-output, both latexify()'ed.
+
+    After each chunk, each complete child of div.mw-parser-output is
+    latexify()'ed, and dropped if is_irrelevant(), and the rest of the page
+    (the <head>, navigation, sidebars, footers, ...) is dropped without being
+    latexify()'ed, so at most about a chunk of the page is held in memory
+    besides the article content. The tree is still built by the C
+    TreeBuilder, unlike with a Python parser target or iterparse() events,
+    which would cost a Python call per element.
+    """
+    builder = ET.TreeBuilder()
+    # a root of our own, so that the partial tree can be walked while it is built
+    pruner = ContentPruner(builder.start('root', {}))
+    parser = ET.XMLParser(target=builder)
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i:i+chunk_size])
+        pruner.prune(final=False)
+    parser.close()
+    pruner.close()
+    return pruner.h1, pruner.nodes
+
+
 class WikiArticle:
     """
     A structured representation of a wikipedia article.
@@ -156,6 +354,10 @@ class WikiArticle:
     The implementation of this class takes advantage of the very specific
     format of each article.
     """
+    # Bump whenever the article parsed from some page may change, so that
+    # serialized articles (see article_cache.py) are invalidated.
+    PARSER_VERSION = 1
+
     @staticmethod
     def fix_malformed_html(text):
         """
@@ -168,17 +370,28 @@ class WikiArticle:
                 )
         return text.replace(line_hack[0], line_hack[1])
 
-    def __init__(self, text: str):
+    def __init__(self, text: str, streaming: bool=True):
+        """
+        streaming=False parses the whole html into a tree before picking out
+        the content, rather than using stream_content(), which needs a
+        fraction of the memory and is no slower. The two build the same
+        WikiTree.
+        """
         self.sections: List[WikiSection] = []
 
-        tree = ET.fromstring(WikiArticle.fix_malformed_html(text))
+        text = WikiArticle.fix_malformed_html(text)
+        if streaming:
+            h1, nodes = stream_content(text)
+            self._root = WikiTree(h1, nodes)
+            return
+
+        tree = ET.fromstring(text)
         latexify(tree)
-        body = tree.find('body')
-        content = get_node(body, 'div', {'id': 'content'})
-        h1 = get_node(content, 'h1')
-        body_content = get_node(content, 'div', {'id': 'bodyContent'})
-        mw_content_text = get_node(body_content, 'div', {'id': 'mw-content-text'})
-        mw_parser_output = get_node(mw_content_text, 'div', {'class': 'mw-parser-output'})
+        nodes = NodeIndex(tree)
+        content = nodes.get_path('body/div#content')
+        h1 = nodes.get_node(content, 'h1')
+        mw_parser_output = nodes.get_path('div#bodyContent/div#mw-content-text/div.mw-parser-output',
+                content)
 
         # mw_parser_output is the meat of the article. Segment into sections by
         # looking for h2 tags
@@ -189,22 +402,36 @@ class WikiArticle:
     def root(self) -> WikiTree:
         return self._root
 
+    def links(self) -> List[str]:
+        return self.root.links()
+
+    def to_json(self) -> dict:
+        return self.root.to_json()
+
+    @staticmethod
+    def from_json(d: dict) -> 'WikiArticle':
+        """
+        The inverse of to_json(), without parsing any html.
+        """
+        article = WikiArticle.__new__(WikiArticle)
+        article.sections = []
+        article._root = WikiTree.from_json(d)
+        return article
+
     def dump(self, column_width: Optional[int]=None):
         self.root.dump(column_width)
 
 
-class WikipediaParser:
-    def __init__(self, cache: Optional[WebCache]=None):
-        self._cache = cache
-        if cache is None:
-            self._cache = WebCache()
-
-    def parse(self, url) -> WikiArticle:
+class WikipediaParser(ArticleParser):
+    """
+    Parses articles such as https://en.wikipedia.org/wiki/Circle.
+    """
+    def __init__(self, cache: Optional[WebCache]=None, article_cache_bytes: int=0,
+            parsed_cache: Optional[ArticleCache]=None):
         """
-        Example url: https://en.wikipedia.org/wiki/Circle
+        See ArticleParser.
         """
-        text = self._cache.html_request(url)
-        return WikiArticle(text)
+        super().__init__(WikiArticle, lambda url: url, cache, article_cache_bytes, parsed_cache)
 
 
 def main():
@@ -215,9 +442,9 @@ def main():
         pass
 
     topic = sys.argv[1].lower()
-    parser = WikipediaParser()
+    parser = WikipediaParser(parsed_cache=ArticleCache())
     if not topic.startswith('http'):
-        url = f'https://en.wikipedia.org/wiki/{topic}'
+        url = article_url(topic)
     else:
         url = topic
     parser.parse(url).dump()
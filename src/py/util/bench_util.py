@@ -0,0 +1,76 @@
+"""
+What the benchmarks (see math_brain/bench_*.py) share: rates of results,
+printing them, and a JSON-lines history of runs, each compared with the
+previous one, so that regressions are visible run to run.
+"""
+import json
+import os
+import sys
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence
+
+
+class Column(NamedTuple):
+    header: str
+    width: int
+    # formats the value of the column from a result, as returned by result_to_json()
+    format: Callable[[dict], str]
+
+
+CHARS_PER_SEC = Column('chars/s', 12, lambda r: f'{r["chars_per_sec"]:,.0f}')
+PEAK_MB = Column('peak MB', 9, lambda r: f'{r["peak_bytes"] / 2**20:.2f}')
+FAILED = Column('failed', 6, lambda r: str(r['failed']))
+
+
+def result_to_json(result: NamedTuple, counts: Sequence[str]=('chars',)) -> dict:
+    """
+    The fields of <result>, plus, for each field named in <counts>, its rate
+    over result.seconds, as <count>_per_sec.
+    """
+    d = result._asdict()
+    for count in counts:
+        d[f'{count}_per_sec'] = d[count] / result.seconds if result.seconds else 0
+    return d
+
+
+def print_results(results: Dict[str, Dict[str, dict]], previous: Optional[dict],
+        columns: List[Column], key: str, group_width: int=8):
+    """
+    Prints results, as {<key>: {group: result_to_json() of a result}}, one row per
+    (key, group), comparing chars/s with <previous>, an earlier run.
+    """
+    print(f'{key:10} {"group":{group_width}} ' +
+            ' '.join(f'{column.header:>{column.width}}' for column in columns) + '  vs previous')
+    for k, groups in results.items():
+        for group, r in groups.items():
+            line = f'{k:10} {group:{group_width}} ' + ' '.join(
+                    f'{column.format(r):>{column.width}}' for column in columns)
+            prev = None if previous is None else previous['results'].get(k, {}).get(group)
+            if prev and prev['chars_per_sec']:
+                line += f'  {r["chars_per_sec"] / prev["chars_per_sec"]:.2f}x'
+            print(line)
+
+
+def last_run(history_path: str) -> Optional[dict]:
+    """
+    The latest run in the history, or None if there is none yet.
+    """
+    if not os.path.isfile(history_path):
+        return None
+    with open(history_path) as f:
+        lines = f.read().splitlines()
+    return json.loads(lines[-1]) if lines else None
+
+
+def append_run(history_path: str, run: dict):
+    """
+    Appends <run> to the history, stamped with the time and python version.
+    """
+    run = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        **run,
+    }
+    os.makedirs(os.path.dirname(history_path), exist_ok=True)
+    with open(history_path, 'a') as f:
+        f.write(json.dumps(run) + '\n')
@@ -0,0 +1,133 @@
+"""
+A hash-keyed, size-bounded cache of bytes on disk, which the caches of derived
+artifacts (see math_brain/token_cache.py and math_brain/article_cache.py) are
+built on.
+"""
+import os
+import tempfile
+from typing import Callable, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class CachedError(Exception):
+    """
+    Raised by DiskCache.load() when computing the value failed, whether it
+    just failed or the failure was cached by an earlier load(), so that
+    callers see the same type either way. type_name is the name of the type
+    of the original error, which is chained as __cause__ when it just failed.
+    """
+    def __init__(self, type_name: str, message: str):
+        super().__init__(f'{type_name}: {message}')
+        self.type_name = type_name
+        self.message = message
+
+
+class DiskCache:
+    """
+    Entries are at <cache_dir>/ab/<rest of key>, for hex keys, such as
+    hashes of what the value is derived from, and their mtimes mark when they
+    were last used.
+    """
+    # Prefix of entries that record an error rather than a value
+    error_magic = b'ERR\0'
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        """
+        When the cache grows past max_bytes, the least recently used entries
+        are evicted.
+        """
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._size: Optional[int] = None  # computed on first put_bytes()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._cache_dir, key[:2], key[2:])
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        """
+        Returns the entry for key, or None on a miss. Raises CachedError if
+        the entry records an error.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            pass  # evicted by another process since the read
+        if data.startswith(self.error_magic):
+            type_name, _, message = data[len(self.error_magic):].decode('utf-8').partition('\n')
+            raise CachedError(type_name, message)
+        return data
+
+    def put_bytes(self, key: str, data: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write-then-rename, so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += len(data)
+        if self._size > self._max_bytes:
+            self._evict()
+
+    def load(self,
+            key: str,
+            compute: Callable[[], T],
+            serialize: Callable[[T], bytes],
+            deserialize: Callable[[bytes], T]) -> T:
+        """
+        Returns deserialize() of the entry for key, or, on a miss, compute(),
+        storing it serialize()'d. If compute() raises, the error is stored
+        instead, so that it is not computed again, and raised as a
+        CachedError, as later loads of key raise it.
+        """
+        data = self.get_bytes(key)
+        if data is not None:
+            return deserialize(data)
+        try:
+            value = compute()
+        except Exception as e:
+            type_name = type(e).__name__
+            self.put_bytes(key, self.error_magic +
+                    f'{type_name}\n{e}'.encode('utf-8', 'backslashreplace'))
+            raise CachedError(type_name, str(e)) from e
+        self.put_bytes(key, serialize(value))
+        return value
+
+    def _entries(self):
+        """
+        Yields (path, size, mtime) for every entry.
+        """
+        for dirpath, _, filenames in os.walk(self._cache_dir):
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue  # in-progress put_bytes()
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue  # evicted by another process
+                yield path, st.st_size, st.st_mtime
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self._size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self._size <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
@@ -0,0 +1,81 @@
+"""
+A bounded, thread-safe, least-recently-used cache.
+"""
+from collections import OrderedDict
+import sys
+import threading
+from typing import Any, Hashable, Optional
+
+
+class LruCache:
+    def __init__(self, max_bytes: int):
+        """
+        Holds values whose sizes, as given to put(), add up to at most
+        max_bytes, evicting the least recently used ones to make room.
+        """
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: Optional[int]=None):
+        """
+        size defaults to sys.getsizeof(value), which is right for str and
+        bytes, but not for containers. A value bigger than the whole cache is
+        not stored.
+        """
+        if size is None:
+            size = sys.getsizeof(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            if size > self._max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def num_bytes(self) -> int:
+        return self._bytes
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    def __repr__(self) -> str:
+        return (f'LruCache({len(self)} entries, {self._bytes}/{self._max_bytes} bytes, '
+                f'{self._hits} hits, {self._misses} misses)')
@@ -0,0 +1,204 @@
+"""
+Tests of WebCache against a local stand-in HTTP server.
+
+Run with: python -m unittest util.test_web_cache (from src/py), or pytest.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import shutil
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+
+from util.web_cache import WebCache
+
+SLOW_SECONDS = 0.2
+ETAG = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    /slow/... answers after SLOW_SECONDS, /etag answers 304 to a matching
+    If-None-Match, /drop closes the connection after answering without
+    saying so (as a server dropping an idle keep-alive connection does),
+    /missing is a 404, and anything else is a plain page.
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.active += 1
+            server.peak_active = max(server.peak_active, server.active)
+        try:
+            if self.path.startswith('/slow/'):
+                time.sleep(SLOW_SECONDS)
+            if self.path == '/missing':
+                self.send_error(404)
+                return
+            if self.path == '/etag' and self.headers.get('If-None-Match') == ETAG:
+                server.statuses.append(304)
+                self.send_response(304)
+                self.send_header('ETag', ETAG)
+                self.end_headers()
+                return
+            body = f'page {self.path}'.encode('utf-8')
+            server.statuses.append(200)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            if self.path == '/etag':
+                self.send_header('ETag', ETAG)
+            self.end_headers()
+            self.wfile.write(body)
+            if self.path == '/drop':
+                self.close_connection = True
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+class LocalServerTest(unittest.TestCase):
+    """
+    Runs a handler_class server on localhost for each test, and gives it a
+    scratch cache directory.
+    """
+    handler_class = Handler
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.statuses = []
+        self.server.active = 0
+        self.server.peak_active = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def web_cache(self, **kwargs) -> WebCache:
+        cache = WebCache(self.cache_dir, **kwargs)
+        self.caches.append(cache)
+        return cache
+
+    def url(self, path: str) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}{path}'
+
+
+class WebCacheTest(LocalServerTest):
+    def test_fetch_and_cache(self):
+        cache = self.web_cache()
+        self.assertEqual(cache.html_request(self.url('/a')), 'page /a')
+        self.assertEqual(cache.html_request(self.url('/a')), 'page /a')
+        self.assertEqual(self.server.requests, ['/a'])
+        # and from disk, by another WebCache
+        self.assertEqual(self.web_cache().html_request(self.url('/a')), 'page /a')
+        self.assertEqual(self.server.requests, ['/a'])
+
+    def test_keep_alive_reuse(self):
+        cache = self.web_cache(max_per_host=1)
+        paths = [f'/p{i}' for i in range(5)]
+        texts = cache.fetch_many([self.url(path) for path in paths])
+        self.assertEqual(texts, [f'page {path}' for path in paths])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_retry_dropped_idle_connection(self):
+        cache = self.web_cache(max_per_host=1)
+        self.assertEqual(cache.html_request(self.url('/drop')), 'page /drop')
+        time.sleep(0.05)  # let the server close its end
+        self.assertEqual(cache.html_request(self.url('/a')), 'page /a')
+        self.assertEqual(self.server.requests, ['/drop', '/a'])
+        self.assertEqual(self.server.connections, 2)
+
+    def test_in_flight_dedup(self):
+        cache = self.web_cache()
+        url = self.url('/slow/x')
+        results = []
+        thread = threading.Thread(target=lambda: results.extend(cache.fetch_many([url])))
+        thread.start()
+        results.extend(cache.fetch_many([url, url, url.upper().replace('HTTP://', 'http://')]))
+        thread.join()
+        self.assertEqual(results, ['page /slow/x'] * 4)
+        self.assertEqual(self.server.requests, ['/slow/x'])
+
+    def test_per_host_limit(self):
+        cache = self.web_cache(max_workers=8, max_per_host=2)
+        urls = [self.url(f'/slow/{i}') for i in range(6)]
+        start = time.monotonic()
+        cache.fetch_many(urls)
+        elapsed = time.monotonic() - start
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertEqual(self.server.peak_active, 2)
+        self.assertGreaterEqual(elapsed, 3 * SLOW_SECONDS)
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_revalidate_with_304(self):
+        cache = self.web_cache(ttl=0)
+        self.assertEqual(cache.html_request(self.url('/etag')), 'page /etag')
+        key = cache._cache_key(cache.normalize(self.url('/etag')))
+        fetch_time = cache._read(key).fetch_time
+        time.sleep(0.01)
+        self.assertEqual(cache.html_request(self.url('/etag')), 'page /etag')
+        self.assertEqual(self.server.statuses, [200, 304])
+        entry = cache._read(key)
+        self.assertEqual(entry.text, 'page /etag')
+        self.assertEqual(entry.etag, ETAG)
+        self.assertGreater(entry.fetch_time, fetch_time)
+
+    def test_fresh_entry_not_revalidated(self):
+        cache = self.web_cache(ttl=3600)
+        cache.html_request(self.url('/etag'))
+        cache.html_request(self.url('/etag'))
+        self.assertEqual(self.server.statuses, [200])
+
+    def test_fetch_entries(self):
+        cache = self.web_cache(ttl=0.05)
+        entry, = cache.fetch_entries([self.url('/etag')])
+        self.assertEqual(entry.text, 'page /etag')
+        self.assertTrue(cache.is_fresh(entry.fetch_time))
+        time.sleep(0.1)
+        self.assertFalse(cache.is_fresh(entry.fetch_time))
+        revalidated, = cache.fetch_entries([self.url('/etag')])
+        self.assertGreater(revalidated.fetch_time, entry.fetch_time)
+        self.assertEqual(self.server.statuses, [200, 304])
+
+    def test_http_error(self):
+        cache = self.web_cache()
+        with self.assertRaises(urllib.error.HTTPError) as e:
+            cache.html_request(self.url('/missing'))
+        self.assertEqual(e.exception.code, 404)
+        results = cache.fetch_many([self.url('/a'), self.url('/missing')], return_exceptions=True)
+        self.assertEqual(results[0], 'page /a')
+        self.assertIsInstance(results[1], urllib.error.HTTPError)
+
+    def test_error_raised_once_all_finished(self):
+        cache = self.web_cache()
+        with self.assertRaises(urllib.error.HTTPError):
+            cache.fetch_many([self.url('/missing'), self.url('/slow/x')])
+        # the slow page was already fetched and cached
+        self.assertIsNotNone(cache._read(cache._cache_key(cache.normalize(self.url('/slow/x')))))
+
+
+if __name__ == '__main__':
+    unittest.main()
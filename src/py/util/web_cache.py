@@ -1,47 +1,503 @@
 """
 Module to access a local cache of web content.
 """
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import hashlib
+import http.client
+import json
+import lzma
 import os
 import re
-from typing import Optional
-import urllib.request
+import sys
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+import urllib.error
+import urllib.parse
+import zlib
+
+from util.lru_cache import LruCache
 
 DEFAULT_WEB_CACHE_DIRECTORY = os.path.expanduser(f'~/mathbrain/web_cache')
 
+# what urllib.request.urlopen sends, which is what we used to fetch with
+USER_AGENT = f'Python-urllib/{sys.version_info[0]}.{sys.version_info[1]}'
+MAX_REDIRECTS = 10
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+# subdirectory of the cache directory holding the ShardedStore
+STORE_DIRNAME = 'sharded'
+
+# name -> (file extension, compress, decompress)
+CODECS = {
+    'zlib': ('.zz', lambda data: zlib.compress(data, 9), zlib.decompress),
+    'lzma': ('.xz', lzma.compress, lzma.decompress),
+}
+
+
+class CacheEntry(NamedTuple):
+    """
+    A cached page, and what the server said about it.
+    """
+    text: str
+    # time.time() of the last download or revalidation
+    fetch_time: float
+    etag: Optional[str]=None
+    last_modified: Optional[str]=None
+    # in bytes, as downloaded
+    content_length: Optional[int]=None
+
+    def metadata(self) -> dict:
+        d = self._asdict()
+        del d['text']
+        return d
+
+    def age(self) -> float:
+        return time.time() - self.fetch_time
+
+
+class ShardedStore:
+    """
+    Compressed pages, each at <root>/ab/cd/<sha1 of its key>.<codec extension>,
+    where abcd are the first 4 hex digits of the hash, so that no directory
+    grows past 256 entries until the cache holds millions of pages, and paths
+    do not depend on how long or odd the url is.
+
+    Each file is a line of JSON metadata (see CacheEntry) followed by the
+    compressed page, so that both are read with one open(), and replaced
+    together.
+
+    <root>/index.jsonl is an append-only log of what was stored, one JSON
+    object per put(), with the later of two lines for the same key winning.
+    Lookups do not need it; it is there to map hashes back to urls, and to
+    size up the cache without walking it.
+    """
+    def __init__(self, root: str, codec: str='zlib'):
+        assert codec in CODECS, f'Invalid codec: "{codec}"'
+        self._root = root
+        self._codec = codec
+        # look for the preferred codec first
+        self._codecs = [codec] + [c for c in CODECS if c != codec]
+        self._index_path = os.path.join(root, 'index.jsonl')
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def hash(key: str) -> str:
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _path(self, h: str, codec: str) -> str:
+        return os.path.join(self._root, h[:2], h[2:4], h + CODECS[codec][0])
+
+    def _read(self, h: str) -> Optional[Tuple[str, dict, bytes]]:
+        """
+        Returns (codec, metadata, compressed page) of the file for hash h.
+        """
+        for codec in self._codecs:
+            path = self._path(h, codec)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            if data.startswith(b'{'):
+                header, _, compressed = data.partition(b'\n')
+                return codec, json.loads(header), compressed
+            # written before metadata was stored
+            return codec, {'fetch_time': os.path.getmtime(path)}, data
+        return None
+
+    def _write(self, h: str, metadata: dict, compressed: bytes):
+        path = self._path(h, self._codec)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write-then-rename, so that concurrent readers never see a partial page
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(metadata).encode('utf-8') + b'\n')
+            f.write(compressed)
+        os.replace(tmp_path, path)
+        for codec in self._codecs[1:]:
+            # a store that prefers that codec would read the stale copy instead
+            if os.path.isfile(self._path(h, codec)):
+                os.remove(self._path(h, codec))
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        found = self._read(self.hash(key))
+        if found is None:
+            return None
+        codec, metadata, compressed = found
+        return CacheEntry(CODECS[codec][2](compressed).decode('utf-8'), **metadata)
+
+    def put(self, key: str, entry: CacheEntry):
+        h = self.hash(key)
+        data = entry.text.encode('utf-8')
+        compressed = CODECS[self._codec][1](data)
+        self._write(h, entry.metadata(), compressed)
+        line = {'key': key, 'hash': h, 'codec': self._codec, 'size': len(data),
+                'stored_size': len(compressed), 'time': time.time()}
+        with self._lock, open(self._index_path, 'a') as f:
+            f.write(json.dumps(line) + '\n')
+
+    def refresh(self, key: str, entry: CacheEntry):
+        """
+        Like put(), for an entry whose text is unchanged, e.g. after a 304:
+        rewrites only the metadata, reusing the compressed page.
+        """
+        found = self._read(self.hash(key))
+        if found is None or found[0] != self._codec:
+            self.put(key, entry)
+            return
+        self._write(self.hash(key), entry.metadata(), found[2])
+
+    def index(self) -> Dict[str, dict]:
+        """
+        {key: the latest index entry for it}
+        """
+        entries = {}
+        if os.path.isfile(self._index_path):
+            with open(self._index_path) as f:
+                for line in f:
+                    if line.endswith('\n'):  # skip a line cut short by a crash
+                        entry = json.loads(line)
+                        entries[entry['key']] = entry
+        return entries
+
+
+class HostPool:
+    """
+    Keep-alive connections to one host (scheme://netloc), at most
+    max_connections of them in use at a time, with request starts at least
+    min_interval seconds apart.
+    """
+    def __init__(self, scheme: str, netloc: str, max_connections: int, min_interval: float,
+            timeout: float):
+        assert scheme in ('http', 'https'), f'Unsupported scheme: "{scheme}"'
+        self._scheme = scheme
+        self._netloc = netloc
+        self._timeout = timeout
+        self._min_interval = min_interval
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._idle: List[http.client.HTTPConnection] = []
+        self._next_start = 0.0
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self._scheme == 'https':
+            return http.client.HTTPSConnection(self._netloc, timeout=self._timeout)
+        return http.client.HTTPConnection(self._netloc, timeout=self._timeout)
+
+    def _wait_turn(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self._min_interval
+        if start > now:
+            time.sleep(start - now)
+
+    def get(self, path: str, headers: Dict[str, str]) -> Tuple[int, str, http.client.HTTPMessage,
+            bytes]:
+        """
+        GETs <path>, sending <headers> on top of the usual ones, returning
+        (status, reason, response headers, body).
+        """
+        with self._slots:
+            self._wait_turn()
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect()
+            headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'identity', **headers}
+            while True:
+                try:
+                    conn.request('GET', path, headers=headers)
+                    response = conn.getresponse()
+                    body = response.read()
+                    break
+                except (http.client.HTTPException, OSError):
+                    conn.close()
+                    if not reused:
+                        raise
+                    # the server may have dropped an idle connection; retry once on a fresh one
+                    reused = False
+                    conn = self._connect()
+            if response.will_close:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+        return response.status, response.reason, response.headers, body
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
 
 class WebCache:
     def __init__(self,
             cache_dir: Optional[str]=DEFAULT_WEB_CACHE_DIRECTORY,
-            mode: str='rw'):
+            mode: str='rw',
+            max_workers: int=16,
+            max_per_host: int=4,
+            requests_per_second: Optional[float]=None,
+            timeout: float=60,
+            codec: str='zlib',
+            memory_bytes: int=0,
+            ttl: Optional[float]=None):
         """
         mode 'r': means read cache
         mode 'w': means write cache
+
+        Pages are written to a ShardedStore, compressed with codec, under
+        cache_dir. Pages cached in the legacy layout (a plain file at the
+        path spelled out by the url) are still read, and moved into the store
+        when read in 'w' mode; see also migrate().
+
+        If memory_bytes is nonzero, up to that many bytes of recently used
+        pages are also kept in memory, in front of the disk, in 'r' mode.
+
+        Pages are stored with their fetch time, ETag and Last-Modified. If ttl
+        is given, in 'r' mode, pages fetched more than ttl seconds ago are
+        revalidated with a conditional request, which costs only headers if
+        the page is unchanged (a 304). To refresh a set of pages, fetch them
+        with ttl=0.
+
+        Downloads run on up to max_workers threads, with at most max_per_host
+        concurrent requests (each on a reused keep-alive connection), and, if
+        requests_per_second is given, at most that many request starts per
+        second, to any one host.
         """
         self._cache_dir = cache_dir
         if not os.path.isdir(cache_dir):
             os.makedirs(cache_dir)
         for m in mode:
             assert m in 'rw', f'Invalid mode: "{mode}"'
+        assert max_per_host > 0, max_per_host
         self._read_mode = 'r' in mode
         self._write_mode = 'w' in mode
         self._http_regex = re.compile(r"https?://(www\.)?")
+        self._store = ShardedStore(os.path.join(cache_dir, STORE_DIRNAME), codec)
+        self._memory = LruCache(memory_bytes) if memory_bytes and self._read_mode else None
+        self._max_workers = max_workers
+        self._max_per_host = max_per_host
+        self._min_interval = 0.0 if requests_per_second is None else 1 / requests_per_second
+        self._timeout = timeout
+        self._ttl = ttl
+        self._lock = threading.RLock()  # re-entered if a future is done before its callback is added
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._hosts: Dict[Tuple[str, str], HostPool] = {}
+        self._in_flight: Dict[str, Future] = {}
+
+    def normalize(self, url: str) -> str:
+        """
+        The url as requested and cached: lower-cased, since that is how the
+        cache has always been keyed.
+        """
+        return url.lower()
+
+    def _cache_key(self, url: str) -> str:
+        """
+        The normalized url, stripped of its scheme and www.
+        """
+        return self._http_regex.sub('', url).strip().strip('/')
+
+    def _legacy_file(self, key: str) -> str:
+        return os.path.join(self._cache_dir, key)
+
+    def _read(self, key: str) -> Optional[CacheEntry]:
+        entry = self._store.get(key)
+        if entry is not None:
+            return entry
+        legacy_file = self._legacy_file(key)
+        if not os.path.isfile(legacy_file):
+            return None
+        try:
+            with open(legacy_file) as f:
+                entry = CacheEntry(f.read(), os.path.getmtime(legacy_file))
+        except FileNotFoundError:
+            # another thread moved it into the store meanwhile
+            return self._store.get(key)
+        if self._write_mode:
+            self._store.put(key, entry)
+            try:
+                os.remove(legacy_file)
+            except FileNotFoundError:
+                pass
+        return entry
+
+    def migrate(self) -> int:
+        """
+        Moves every page cached in the legacy layout into the store. Returns
+        the number of pages moved.
+        """
+        moved = 0
+        for dirpath, dirnames, filenames in os.walk(self._cache_dir):
+            if dirpath == self._cache_dir and STORE_DIRNAME in dirnames:
+                dirnames.remove(STORE_DIRNAME)
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                legacy_file = os.path.join(dirpath, filename)
+                key = os.path.relpath(legacy_file, self._cache_dir).replace(os.sep, '/')
+                with open(legacy_file) as f:
+                    self._store.put(key, CacheEntry(f.read(), os.path.getmtime(legacy_file)))
+                os.remove(legacy_file)
+                moved += 1
+        # remove the legacy directories this left empty, bottom-up
+        for dirpath, dirnames, _ in sorted(os.walk(self._cache_dir), reverse=True):
+            if dirpath == self._cache_dir:
+                continue
+            if os.path.relpath(dirpath, self._cache_dir).split(os.sep)[0] == STORE_DIRNAME:
+                continue
+            if not os.listdir(dirpath):
+                os.rmdir(dirpath)
+        return moved
 
     def html_request(self, url: str) -> str:
         """
         Takes a url and returns the url content.
         """
-        url = url.lower()  # to normalize cache
-        stripped_url = self._http_regex.sub('', url).strip().strip('/')
-        cache_file = os.path.join(self._cache_dir, stripped_url)
-        if self._read_mode and os.path.isfile(cache_file):
-            with open(cache_file) as f:
-                return f.read()
-        with urllib.request.urlopen(url) as u:
-            text = u.read().decode('utf-8')
+        return self._request(self.normalize(url)).result().text
+
+    def fetch_many(self, urls: Sequence[str], return_exceptions: bool=False) -> List:
+        """
+        Like [self.html_request(url) for url in urls], but downloads
+        concurrently. Urls that normalize to the same one, here or in a
+        concurrent call, are only downloaded once.
+
+        If a download fails, raises its exception once all have finished,
+        unless return_exceptions, in which case the exception takes the
+        place of the content in the returned list.
+        """
+        return [entry.text if isinstance(entry, CacheEntry) else entry
+                for entry in self.fetch_entries(urls, return_exceptions)]
+
+    def fetch_entries(self, urls: Sequence[str], return_exceptions: bool=False) -> List:
+        """
+        Like fetch_many(), but returns the CacheEntry of each page, e.g. for
+        its fetch_time, rather than just its content.
+        """
+        futures = [self._request(self.normalize(url)) for url in urls]
+        wait(futures)
+        results = []
+        for future in futures:
+            e = future.exception()
+            if e is not None and not return_exceptions:
+                raise e
+            results.append(future.result() if e is None else e)
+        return results
+
+    @property
+    def memory(self) -> Optional[LruCache]:
+        """
+        The in-memory tier, if any, e.g. for its hit/miss counts.
+        """
+        return self._memory
+
+    def is_fresh(self, fetch_time: float) -> bool:
+        """
+        Whether a page fetched at fetch_time is still served as is, rather
+        than revalidated first.
+        """
+        return self._ttl is None or time.time() - fetch_time <= self._ttl
+
+    def _remember(self, key: str, entry: CacheEntry):
+        if self._memory is not None:
+            self._memory.put(key, entry, sys.getsizeof(entry.text))
+
+    def _request(self, url: str) -> Future:
+        key = self._cache_key(url)
+        entry = None
+        if self._memory is not None:
+            entry = self._memory.get(key)
+        if entry is None and self._read_mode:
+            entry = self._read(key)
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is not None and self.is_fresh(entry.fetch_time):
+            future = Future()
+            future.set_result(entry)
+            return future
+        with self._lock:
+            future = self._in_flight.get(url)
+            if future is None:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self._max_workers,
+                            thread_name_prefix='WebCache')
+                future = self._executor.submit(self._fetch, url, key, entry)
+                self._in_flight[url] = future
+                future.add_done_callback(lambda _: self._done(url))
+        return future
+
+    def _done(self, url: str):
+        with self._lock:
+            self._in_flight.pop(url, None)
+
+    def _host(self, scheme: str, netloc: str) -> HostPool:
+        with self._lock:
+            pool = self._hosts.get((scheme, netloc))
+            if pool is None:
+                pool = HostPool(scheme, netloc, self._max_per_host, self._min_interval,
+                        self._timeout)
+                self._hosts[(scheme, netloc)] = pool
+            return pool
+
+    def _fetch(self, url: str, key: str, stale: Optional[CacheEntry]) -> CacheEntry:
+        """
+        Downloads url, or, if there is a stale entry for it, revalidates that.
+        """
+        conditions = {}
+        if stale is not None and stale.etag is not None:
+            conditions['If-None-Match'] = stale.etag
+        if stale is not None and stale.last_modified is not None:
+            conditions['If-Modified-Since'] = stale.last_modified
+        status, headers, body = self._download(url, conditions)
+        if status == 304:
+            entry = stale._replace(fetch_time=time.time())
             if self._write_mode:
-                cache_file_dir = os.path.split(cache_file)[0]
-                os.makedirs(cache_file_dir, exist_ok=True)
-                with open(cache_file, 'w') as f:
-                    f.write(text)
-        return text
+                self._store.refresh(key, entry)
+        else:
+            entry = CacheEntry(body.decode('utf-8'), time.time(), headers.get('ETag'),
+                    headers.get('Last-Modified'), len(body))
+            if self._write_mode:
+                self._store.put(key, entry)
+        self._remember(key, entry)
+        return entry
 
+    def _download(self, url: str, conditions: Dict[str, str]) -> Tuple[int,
+            http.client.HTTPMessage, bytes]:
+        """
+        GETs url, following redirects, as urllib.request.urlopen would.
+        Returns (status, headers, body), where status is 304 only if
+        conditions (e.g. If-None-Match) were given and met.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            status, reason, headers, body = self._host(parts.scheme, parts.netloc).get(path,
+                    conditions)
+            location = headers.get('Location')
+            if status in REDIRECT_STATUSES and location is not None:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if not (200 <= status < 300 or (status == 304 and conditions)):
+                raise urllib.error.HTTPError(url, status, reason, headers, None)
+            return status, headers, body
+        raise urllib.error.HTTPError(url, status, 'Too many redirects', headers, None)
+
+    def close(self):
+        """
+        Waits for pending downloads, then closes idle connections.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+            hosts = list(self._hosts.values())
+            self._hosts.clear()
+        if executor is not None:
+            executor.shutdown()
+        for pool in hosts:
+            pool.close()
@@ -1,11 +1,28 @@
-from typing import Dict, List, Optional
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+import weakref
 import xml.etree.ElementTree as ET
 
 
+# Attributes by which NodeIndex indexes elements
+INDEXED_ATTRIBS = ('id', 'class')
+
+# element -> get_inside_text(element), for cached_inside_text()
+_inside_text_cache: 'weakref.WeakKeyDictionary[ET.Element, str]' = weakref.WeakKeyDictionary()
+
+
 def elem_to_str(elem: ET.Element) -> str:
     return ET.tostring(elem).decode('utf-8')
 
 
+def str_to_elem(text: str) -> ET.Element:
+    """
+    The inverse of elem_to_str(), which includes the element's tail, so
+    parses text inside a wrapper element.
+    """
+    return ET.fromstring(f'<wrapper>{text}</wrapper>')[0]
+
+
 def get_inside_text(element: ET.Element) -> Optional[str]:
     """
     Returns everything between <foo> and closing </foo>.
@@ -20,12 +37,37 @@ def get_inside_text(element: ET.Element) -> Optional[str]:
     return ''.join(tokens).strip()
 
 
+def has_inside_text(element: ET.Element) -> bool:
+    """
+    Whether get_inside_text(element) is non-empty, without serializing
+    anything: it is as soon as element has a child, whose tags are part of it,
+    so this only looks at the text and tail.
+    """
+    return len(element) > 0 or bool((element.text or '').strip() or (element.tail or '').strip())
+
+
+def cached_inside_text(element: ET.Element) -> str:
+    """
+    Like get_inside_text(element), remembered for as long as element lives, so
+    element must not change once passed here.
+    """
+    text = _inside_text_cache.get(element)
+    if text is None:
+        text = get_inside_text(element)
+        _inside_text_cache[element] = text
+    return text
+
+
+def matches(node: ET.Element, tag: Optional[str], attribs: Dict[str, str]) -> bool:
+    return node.tag == tag and all(node.attrib.get(k) == v for k, v in attribs.items())
+
+
 def get_node(
         tree: ET.Element,
         tag: Optional[str]=None,
         attribs: Optional[Dict[str, str]]=None,
         index: Optional[int]=None
-        ) -> List[ET.Element]:
+        ) -> ET.Element:
     """
     Finds the top-level nodes of <tree> which match <tag> and whose attrib
     mappings contains <attribs>.
@@ -36,10 +78,103 @@ def get_node(
     if attribs is None:
         attribs = {}
 
-    nodes = [node for node in list(tree) if node.tag == tag and
-            all([node.attrib.get(k, None)==v for k, v in attribs.items()])]
+    nodes = [node for node in tree if matches(node, tag, attribs)]
     if index is None:
-        assert len(nodes)==1, [(node.tag, node.attrib) for node in list(tree)]
+        assert len(nodes)==1, [(node.tag, node.attrib) for node in tree]
         return nodes[0]
     return nodes[index]
 
+
+@lru_cache(maxsize=None)
+def parse_path(path: str) -> Tuple[Tuple[str, Dict[str, str]], ...]:
+    """
+    'body/div#content/div.mw-parser-output' ->
+        (('body', {}), ('div', {'id': 'content'}), ('div', {'class': 'mw-parser-output'}))
+
+    Like get_node(), a .class step matches the whole class attribute, not one
+    of the classes in it.
+    """
+    steps = []
+    for step in path.split('/'):
+        tag, hash_, id_ = step.partition('#')
+        if hash_:
+            steps.append((tag, {'id': id_}))
+            continue
+        tag, dot, class_ = step.partition('.')
+        steps.append((tag, {'class': class_} if dot else {}))
+    return tuple(steps)
+
+
+def get_path(tree: ET.Element, path: str) -> ET.Element:
+    """
+    Follows get_node() down <tree> along <path> (see parse_path()).
+    """
+    for tag, attribs in parse_path(path):
+        tree = get_node(tree, tag, attribs)
+    return tree
+
+
+class NodeIndex:
+    """
+    Does the lookups of get_node() and get_path() on one tree, indexing the
+    children of each element looked in by tag, and by tag and each of
+    INDEXED_ATTRIBS, so that later lookups there take constant time however
+    wide the element.
+
+    Elements are indexed on first lookup, rather than all up front, which
+    would cost far more than the handful of lookups needed to find the
+    content of a page. The tree must not change once looked in.
+    """
+    def __init__(self, tree: ET.Element):
+        self._tree = tree
+        # element -> {(tag,) or (tag, attrib, value): matching children}
+        self._children: Dict[ET.Element, Dict[tuple, List[ET.Element]]] = {}
+
+    def _index(self, tree: ET.Element) -> Dict[tuple, List[ET.Element]]:
+        index = self._children.get(tree)
+        if index is None:
+            index = {}
+            for node in tree:
+                index.setdefault((node.tag,), []).append(node)
+                for attrib in INDEXED_ATTRIBS:
+                    value = node.attrib.get(attrib)
+                    if value is not None:
+                        index.setdefault((node.tag, attrib, value), []).append(node)
+            self._children[tree] = index
+        return index
+
+    def get_node(
+            self,
+            tree: ET.Element,
+            tag: Optional[str]=None,
+            attribs: Optional[Dict[str, str]]=None,
+            index: Optional[int]=None
+            ) -> ET.Element:
+        """
+        Like get_node(tree, tag, attribs, index).
+        """
+        if attribs is None:
+            attribs = {}
+
+        key = (tag,)
+        for attrib in INDEXED_ATTRIBS:
+            if attrib in attribs:
+                key = (tag, attrib, attribs[attrib])
+                break
+        nodes = self._index(tree).get(key, [])
+        if attribs:
+            nodes = [node for node in nodes if matches(node, tag, attribs)]
+        if index is None:
+            assert len(nodes)==1, [(node.tag, node.attrib) for node in tree]
+            return nodes[0]
+        return nodes[index]
+
+    def get_path(self, path: str, tree: Optional[ET.Element]=None) -> ET.Element:
+        """
+        Like get_path(tree, path), where tree defaults to the whole tree.
+        """
+        if tree is None:
+            tree = self._tree
+        for tag, attribs in parse_path(path):
+            tree = self.get_node(tree, tag, attribs)
+        return tree